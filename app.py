@@ -1,26 +1,65 @@
-from flask import Flask, render_template, request, jsonify, redirect, send_file
+from flask import Flask, render_template, request, jsonify, redirect, send_file, g, has_request_context, Response, stream_with_context
 import numpy as np
 from numpy.linalg import norm
 import pickle
 import os
 import pymysql
 from werkzeug.security import generate_password_hash, check_password_hash
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+from sklearn.feature_extraction.text import TfidfVectorizer, HashingVectorizer
+import scipy.sparse as sp
 import re
 import json
+import shutil
+import hashlib
+import functools
+import itertools
+import threading
+import tempfile
+import time
+try:
+    import fcntl  # 変換の排他用（Windowsには無い）
+except ImportError:
+    fcntl = None
+import queue
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import OrderedDict
 from io import BytesIO
 from openpyxl import Workbook
 from openpyxl.styles import Font, Alignment, Border, Side, PatternFill
 from datetime import datetime
+from generate_synthetic_cases import (
+    DIFFICULTY_KEYWORDS, SUPPORT_KEYWORDS, CARE_LEVELS, DEMENTIA_ADL_LEVELS, DISABILITY_ADL_LEVELS
+)
+
+# 埋め込みモデルの実行方式（"sentence_transformers" / "onnx"）
+EMBEDDING_BACKEND = os.environ.get("EMBEDDING_BACKEND", "sentence_transformers")
 
 # Sentence Transformers for semantic similarity (optional, with fallback to TF-IDF)
+# onnx 指定時は PyTorch の読み込みを避けるため、フォールバックが必要になるまで import しない
+SENTENCE_TRANSFORMERS_AVAILABLE = False
+if EMBEDDING_BACKEND != "onnx":
+    try:
+        from sentence_transformers import SentenceTransformer
+        SENTENCE_TRANSFORMERS_AVAILABLE = True
+    except ImportError:
+        print("Warning: sentence-transformers not installed. Using TF-IDF fallback.")
+
+# ONNX Runtime による CPU 推論（任意）
 try:
-    from sentence_transformers import SentenceTransformer
-    SENTENCE_TRANSFORMERS_AVAILABLE = True
+    import onnxruntime
+    from tokenizers import Tokenizer
+    ONNXRUNTIME_AVAILABLE = True
 except ImportError:
-    SENTENCE_TRANSFORMERS_AVAILABLE = False
-    print("Warning: sentence-transformers not installed. Using TF-IDF fallback.")
+    ONNXRUNTIME_AVAILABLE = False
+    if EMBEDDING_BACKEND == "onnx":
+        print("Warning: onnxruntime / tokenizers not installed. Falling back to sentence-transformers.")
+
+# 近似最近傍探索（HNSW）用ライブラリ（任意、未導入時は全件の内積計算）
+try:
+    import hnswlib
+    HNSWLIB_AVAILABLE = True
+except ImportError:
+    HNSWLIB_AVAILABLE = False
 
 app = Flask(__name__)
 
@@ -37,8 +76,201 @@ DB_CONFIG = {
 }
 
 
+# 接続プールの設定
+DB_POOL_CONFIG = {
+    "max_size": 10,          # 同時に保持する接続の上限
+    "max_idle_time": 300,    # これ以上アイドルだった接続は破棄（秒）
+    "ping_interval": 30,     # 貸し出し前のヘルスチェック間隔（秒）
+    "acquire_timeout": 10    # プール枯渇時の最大待ち時間（秒）
+}
+
+
+class ConnectionPool:
+    """スレッドセーフな上限付きMySQL接続プール"""
+
+    def __init__(self, config, max_size=10, max_idle_time=300, ping_interval=30, acquire_timeout=10):
+        self.config = config
+        self.max_size = max_size
+        self.max_idle_time = max_idle_time
+        self.ping_interval = ping_interval
+        self.acquire_timeout = acquire_timeout
+
+        self._cond = threading.Condition()
+        self._idle = []  # (接続, 最終使用時刻) のスタック
+        self._size = 0   # 貸し出し中 + アイドルの接続数
+        self._pid = os.getpid()
+        self.stats = {
+            "created": 0,
+            "reused": 0,
+            "closed_idle": 0,
+            "failed_health_checks": 0,
+            "exhausted": 0,
+            "timeouts": 0,
+            "wait_time_total": 0.0
+        }
+
+    def _check_fork(self):
+        # fork後の子プロセスでは親の接続を使い回さない
+        if os.getpid() != self._pid:
+            self._pid = os.getpid()
+            self._idle = []
+            self._size = 0
+
+    def acquire(self):
+        """接続を借りる（枯渇時は acquire_timeout 秒まで待つ）"""
+        deadline = time.time() + self.acquire_timeout
+        waited = False
+        while True:
+            conn = None
+            last_used = None
+            with self._cond:
+                self._check_fork()
+                now = time.time()
+                while self._idle:
+                    candidate, candidate_last_used = self._idle.pop()
+                    if now - candidate_last_used > self.max_idle_time:
+                        self._close_quietly(candidate)
+                        self._size -= 1
+                        self.stats["closed_idle"] += 1
+                        continue
+                    conn, last_used = candidate, candidate_last_used
+                    break
+
+                if conn is None:
+                    if self._size < self.max_size:
+                        self._size += 1
+                    else:
+                        if not waited:
+                            self.stats["exhausted"] += 1
+                            waited = True
+                        wait_started = time.time()
+                        remaining = deadline - wait_started
+                        if remaining > 0:
+                            self._cond.wait(remaining)
+                        self.stats["wait_time_total"] += time.time() - wait_started
+                        if time.time() >= deadline:
+                            self.stats["timeouts"] += 1
+                            raise Exception("DB接続プールが枯渇しました")
+                        continue
+
+            if conn is None:
+                try:
+                    conn = pymysql.connect(**self.config)
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+                self.stats["created"] += 1
+                return conn
+
+            # しばらく使われていない接続は貸し出し前に疎通確認
+            if time.time() - last_used > self.ping_interval:
+                try:
+                    conn.ping(reconnect=False)
+                except Exception:
+                    self.stats["failed_health_checks"] += 1
+                    self.discard(conn)
+                    continue
+            self.stats["reused"] += 1
+            return conn
+
+    def release(self, conn):
+        """接続を返却（未確定のトランザクションはロールバック）"""
+        try:
+            conn.rollback()
+        except Exception:
+            self.discard(conn)
+            return
+        with self._cond:
+            self._check_fork()
+            self._idle.append((conn, time.time()))
+            self._cond.notify()
+
+    def discard(self, conn):
+        """壊れた接続を閉じてプールから外す"""
+        self._close_quietly(conn)
+        with self._cond:
+            self._size = max(self._size - 1, 0)
+            self._cond.notify()
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def get_stats(self):
+        with self._cond:
+            return dict(
+                self.stats,
+                size=self._size,
+                idle=len(self._idle),
+                in_use=self._size - len(self._idle),
+                max_size=self.max_size
+            )
+
+
+class PooledConnection:
+    """プールの接続を包むラッパー
+
+    既存コードの `with conn:` や `conn.close()` で接続を閉じる代わりに、
+    プールへの返却（リクエストスコープの場合は何もしない）を行う。
+    """
+
+    def __init__(self, pool, conn, request_scoped=False):
+        self._pool = pool
+        self._conn = conn
+        self._request_scoped = request_scoped
+        self._released = False
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        # リクエストスコープの接続はリクエスト終了時にまとめて返却する
+        if self._request_scoped or self._released:
+            return
+        self._released = True
+        self._pool.release(self._conn)
+
+
+_db_pool = ConnectionPool(DB_CONFIG, **DB_POOL_CONFIG)
+
+
 def get_connection():
-    return pymysql.connect(**DB_CONFIG)
+    """DB接続を取得
+
+    リクエスト処理中は同じ接続を1リクエストの間共有し、
+    それ以外（バックグラウンドスレッドなど）はプールから都度借りる。
+    """
+    if has_request_context():
+        conn = g.get("_db_conn")
+        if conn is None:
+            conn = _db_pool.acquire()
+            g._db_conn = conn
+        return PooledConnection(_db_pool, conn, request_scoped=True)
+    return PooledConnection(_db_pool, _db_pool.acquire())
+
+
+@app.teardown_request
+def release_request_connection(exc):
+    conn = g.pop("_db_conn", None)
+    if conn is not None:
+        _db_pool.release(conn)
+
+
+@app.route("/api/db_pool_stats")
+def db_pool_stats():
+    """接続プールの利用状況（枯渇回数・待ち時間など）"""
+    return jsonify({"status": "ok", "pool": _db_pool.get_stats()})
 
 
 # ================================
@@ -225,39 +457,523 @@ def similar_cases():
 EMBEDDING_MODEL_NAME = "intfloat/multilingual-e5-small"
 EMBEDDINGS_CACHE_FILE = os.path.join(os.path.dirname(__file__), "data", "case_studies", "embeddings.npy")
 EMBEDDINGS_IDS_FILE = os.path.join(os.path.dirname(__file__), "data", "case_studies", "embeddings_ids.json")
+# embeddings.npy を計算したモデル（get_embedding_model_id）。無い場合は sentence-transformers で計算したものとみなす
+EMBEDDINGS_META_FILE = os.path.join(os.path.dirname(__file__), "data", "case_studies", "embeddings_meta.json")
+CASE_STUDIES_FILE = os.path.join(os.path.dirname(__file__), "data", "case_studies", "cases.json")
+# cases.json から変換した検索用のコンパクトな JSON Lines と、表示用テキストのストア
+CASE_SEARCH_STORE_FILE = os.path.join(os.path.dirname(__file__), "data", "case_studies", "cases_search.jsonl")
+CASE_DISPLAY_STORE_FILE = os.path.join(os.path.dirname(__file__), "data", "case_studies", "cases_display.jsonl")
+CASE_STORE_LOCK_FILE = os.path.join(os.path.dirname(__file__), "data", "case_studies", ".cases_store.lock")
+CASE_STORE_FORMAT = 2  # 検索用ストアの形式（項目を増やしたら上げて再変換させる）
+DB_EMBEDDINGS_CACHE_FILE = os.path.join(os.path.dirname(__file__), "data", "case_studies", "db_embeddings.npz")
+DB_EMBEDDINGS_SAVE_DELAY = 2.0  # DBレコード埋め込みの保存をまとめる待ち時間（秒）
+ANN_INDEX_FILE = os.path.join(os.path.dirname(__file__), "data", "case_studies", "embeddings_hnsw.bin")
+
+# ONNX Runtime で実行する場合のモデル（EMBEDDING_BACKEND=onnx）
+ONNX_MODEL_DIR = os.environ.get(
+    "ONNX_MODEL_DIR", os.path.join(os.path.dirname(__file__), "data", "models", "multilingual-e5-small-onnx")
+)
+ONNX_NUM_THREADS = int(os.environ.get("ONNX_NUM_THREADS", "0"))  # 0 は onnxruntime の既定値
+ONNX_QUANTIZE = os.environ.get("ONNX_QUANTIZE", "1") == "1"     # int8 に動的量子化して使う
+
+# 近似最近傍インデックスの設定（件数が ANN_INDEX_MIN_SIZE 以上の場合のみ使用）
+ANN_INDEX_MIN_SIZE = 100000
+ANN_CANDIDATES = 1000     # ANNで取得する候補数
+ANN_EF_CONSTRUCTION = 200
+ANN_EF_SEARCH = 1200      # 検索時の探索幅（ANN_CANDIDATES 以上にする）
+ANN_M = 16
+
+# 埋め込みの量子化（"none" / "float16" / "int8"）。量子化した行列で全件を走査し、
+# 上位 QUANTIZED_RERANK_CANDIDATES 件だけを float32 の埋め込みで再計算して候補とする（ANNと同じ扱い）。
+# int8 はメモリ1/4で走査も速い。float16 はメモリ1/2だが NumPy の変換が遅く走査は遅くなる。
+# 量子化した行列は embeddings.npy の隣に保存し、mmap で開いてワーカー間で共有する
+EMBEDDING_QUANTIZATION = os.environ.get("EMBEDDING_QUANTIZATION", "none")
+QUANTIZED_RERANK_CANDIDATES = ANN_CANDIDATES
+QUANTIZED_SCAN_CHUNK = 1024  # 走査時に float32 へ戻す行数（CPUキャッシュに収まる大きさ）
 
 # グローバル変数でモデルとキャッシュを保持
 _embedding_model = None
 _synthetic_embeddings = None
 _synthetic_ids = None
+_db_record_embeddings = None  # visit_record_id -> (内容ハッシュ, 埋め込みベクトル)
+_db_embeddings_lock = threading.Lock()
+_db_embedding_matrix = (None, None)  # (レコードIDとハッシュの並び, 連続配置した埋め込み行列)
+_db_embeddings_save_timer = None
+_db_embeddings_save_lock = threading.Lock()
+_ann_index = (None, None, None)  # (元の埋め込み行列, 元ファイルのキー, HNSWインデックス)
+_ann_index_lock = threading.Lock()
+_ann_index_thread = None
+_quantized_embeddings = (None, None, None)  # (元の埋め込み行列, 元ファイルのキー, (量子化した行列, 行ごとのスケール))
+_embedding_worker = None
+_embedding_worker_lock = threading.Lock()
+_synthetic_embedding_thread = None
+
+
+class OnnxEmbeddingModel:
+    """ONNX Runtime で multilingual-e5-small を実行する埋め込みモデル
+
+    SentenceTransformer.encode と同じ呼び出し方ができる（平均プーリング + L2正規化）。
+    model_dir には次のコマンドで書き出したモデルを置く:
+        optimum-cli export onnx --model intfloat/multilingual-e5-small --task feature-extraction <model_dir>
+    quantize=True の場合は初回に model.onnx を int8 に動的量子化した model_quantized.onnx を作って使う。
+    """
 
+    def __init__(self, model_dir, num_threads=0, quantize=True, max_length=512):
+        model_path = os.path.join(model_dir, "model.onnx")
+        if quantize:
+            quantized_path = os.path.join(model_dir, "model_quantized.onnx")
+            if not os.path.exists(quantized_path):
+                from onnxruntime.quantization import quantize_dynamic, QuantType
+                print(f"Quantizing ONNX model to int8: {quantized_path}")
+                # 同時に起動した他のワーカーが書きかけのモデルを読まないよう、一意な一時ファイルに書いて置き換える
+                fd, tmp_path = tempfile.mkstemp(dir=model_dir, prefix=".model_quantized.", suffix=".onnx")
+                os.close(fd)
+                try:
+                    quantize_dynamic(model_path, tmp_path, weight_type=QuantType.QInt8)
+                    os.chmod(tmp_path, 0o644)
+                    os.replace(tmp_path, quantized_path)
+                except BaseException:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+                    raise
+            model_path = quantized_path
+        self.quantized = quantize
+
+        options = onnxruntime.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=max_length)
+        self.tokenizer.enable_padding()
+
+    def encode(self, sentences, batch_size=32, show_progress_bar=False, convert_to_numpy=True, **kwargs):
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        outputs = []
+        for start in range(0, len(texts), batch_size):
+            encodings = self.tokenizer.encode_batch(texts[start:start + batch_size])
+            input_ids = np.array([e.ids for e in encodings], dtype=np.int64)
+            attention_mask = np.array([e.attention_mask for e in encodings], dtype=np.int64)
+            inputs = {"input_ids": input_ids, "attention_mask": attention_mask}
+            if "token_type_ids" in self.input_names:
+                inputs["token_type_ids"] = np.zeros_like(input_ids)
+            hidden = self.session.run(None, inputs)[0]
+            # 平均プーリング（パディングは除く）
+            mask = attention_mask[:, :, None].astype(np.float32)
+            pooled = (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+            outputs.append(l2_normalize(pooled))
+        embeddings = np.vstack(outputs) if outputs else np.zeros((0, 0), dtype=np.float32)
+        return embeddings[0] if single else embeddings
+
+
+def _load_onnx_model():
+    if not ONNXRUNTIME_AVAILABLE:
+        return None
+    try:
+        print(f"Loading ONNX embedding model: {ONNX_MODEL_DIR} (threads={ONNX_NUM_THREADS or 'auto'})...")
+        model = OnnxEmbeddingModel(ONNX_MODEL_DIR, ONNX_NUM_THREADS, ONNX_QUANTIZE)
+        print("ONNX embedding model loaded successfully!")
+        return model
+    except Exception as e:
+        print(f"Failed to load ONNX embedding model: {e}")
+        return None
 
-def get_embedding_model():
-    """埋め込みモデルを取得（遅延ロード）"""
-    global _embedding_model
-    if _embedding_model is None and SENTENCE_TRANSFORMERS_AVAILABLE:
+
+_sentence_transformers_import_tried = EMBEDDING_BACKEND != "onnx"
+_onnx_load_failed = False  # 一度失敗したら以降は ONNX を試さない
+
+
+def _load_sentence_transformers_model():
+    global SentenceTransformer, SENTENCE_TRANSFORMERS_AVAILABLE, _sentence_transformers_import_tried
+    if not SENTENCE_TRANSFORMERS_AVAILABLE:
+        # onnx からのフォールバック時だけ、ここで初めて import する
+        if _sentence_transformers_import_tried:
+            return None
+        _sentence_transformers_import_tried = True
         try:
-            print(f"Loading embedding model: {EMBEDDING_MODEL_NAME}...")
-            _embedding_model = SentenceTransformer(EMBEDDING_MODEL_NAME)
-            print("Embedding model loaded successfully!")
-        except Exception as e:
-            print(f"Failed to load embedding model: {e}")
+            from sentence_transformers import SentenceTransformer
+            SENTENCE_TRANSFORMERS_AVAILABLE = True
+        except ImportError:
+            print("Warning: sentence-transformers not installed. Using TF-IDF fallback.")
             return None
+    try:
+        print(f"Loading embedding model: {EMBEDDING_MODEL_NAME}...")
+        model = SentenceTransformer(EMBEDDING_MODEL_NAME)
+        print("Embedding model loaded successfully!")
+        return model
+    except Exception as e:
+        print(f"Failed to load embedding model: {e}")
+        return None
+
+
+def get_embedding_model():
+    """埋め込みモデルを取得（遅延ロード）
+
+    EMBEDDING_BACKEND が onnx の場合は ONNX Runtime を使い、読み込めなければ sentence-transformers に、
+    それも使えなければ None（TF-IDFのみ）にフォールバックする。
+    """
+    global _embedding_model, _onnx_load_failed
+    if _embedding_model is None:
+        if EMBEDDING_BACKEND == "onnx" and not _onnx_load_failed:
+            _embedding_model = _load_onnx_model()
+            _onnx_load_failed = _embedding_model is None
+        if _embedding_model is None:
+            _embedding_model = _load_sentence_transformers_model()
     return _embedding_model
 
 
+def get_embedding_model_id():
+    """埋め込みを計算したモデルを表す文字列（モデル名・実際に使っているバックエンド・ONNXの量子化の有無）
+
+    バックエンドや量子化の有無で埋め込みの値が変わるため、埋め込みのキャッシュのキーと
+    保存した埋め込みのメタデータに含め、一致しない場合は計算し直す。
+    """
+    model = get_embedding_model()
+    if isinstance(model, OnnxEmbeddingModel):
+        return f"{EMBEDDING_MODEL_NAME}:onnx-{'int8' if model.quantized else 'fp32'}"
+    return f"{EMBEDDING_MODEL_NAME}:sentence_transformers"
+
+
+# 推論スレッドの設定
+EMBEDDING_BATCH_MAX_SIZE = 64   # 1回の encode にまとめるテキスト数の上限
+EMBEDDING_BATCH_WAIT = 0.005    # 最初の依頼が届いてから後続の依頼を待つ時間（秒）
+EMBEDDING_ENCODE_TIMEOUT = 60   # 1依頼あたりの完了待ちの上限（秒）
+
+
+class EmbeddingWorker:
+    """埋め込みモデルを専有する推論スレッド
+
+    依頼キューに EMBEDDING_BATCH_WAIT 秒以内に届いた依頼をまとめ、1回の model.encode で処理する。
+    Flask のリクエストスレッドは完了を待つだけで、同時に届いたクエリは同じバッチで計算される。
+    """
+
+    def __init__(self, model, max_batch_size=64, batch_wait=0.005):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.batch_wait = batch_wait
+
+        self._queue = queue.Queue()
+        self._held = None  # 上限を超えるため次のバッチに回した依頼（推論スレッドだけが触る）
+        self._thread = None
+        self._lock = threading.Lock()
+        self._pid = None
+        self.stats = {
+            "jobs": 0,
+            "texts": 0,
+            "batches": 0,
+            "max_batch_jobs": 0,
+            "errors": 0,
+            "encode_time_total": 0.0
+        }
+
+    def _ensure_started(self):
+        with self._lock:
+            # fork後の子プロセスには親のスレッドが引き継がれないので起動し直す
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._queue = queue.Queue()
+                self._held = None
+                self._thread = None
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def submit(self, texts):
+        """テキストのリストのエンコードを依頼し、結果の Future を返す"""
+        self._ensure_started()
+        future = Future()
+        self._queue.put((list(texts), future))
+        return future
+
+    def encode(self, texts, timeout=EMBEDDING_ENCODE_TIMEOUT):
+        """テキストをエンコードして (件数, 次元) の配列を返す
+
+        件数が多い場合は max_batch_size 件ずつ順に依頼し、その間に届いたクエリを待たせない。
+        """
+        chunks = []
+        for start in range(0, len(texts), self.max_batch_size):
+            future = self.submit(texts[start:start + self.max_batch_size])
+            chunks.append(future.result(timeout=timeout))
+        if not chunks:
+            return np.zeros((0, 0), dtype=np.float32)
+        return np.vstack(chunks)
+
+    def _next_batch(self):
+        """次に処理する依頼のリスト（合計件数は max_batch_size 以下。1件で上限を超える依頼は単独で処理）"""
+        if self._held is not None:
+            jobs, self._held = [self._held], None
+        else:
+            jobs = [self._queue.get()]
+        size = len(jobs[0][0])
+        deadline = time.time() + self.batch_wait
+        while size < self.max_batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                job = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if size + len(job[0]) > self.max_batch_size:
+                self._held = job
+                break
+            jobs.append(job)
+            size += len(job[0])
+        return jobs
+
+    def _run(self):
+        while True:
+            jobs = self._next_batch()
+            texts = [text for job_texts, _ in jobs for text in job_texts]
+            started = time.time()
+            try:
+                vectors = self.model.encode(texts, batch_size=self.max_batch_size, convert_to_numpy=True)
+            except Exception as e:
+                self.stats["errors"] += 1
+                for _, future in jobs:
+                    future.set_exception(e)
+                continue
+
+            self.stats["jobs"] += len(jobs)
+            self.stats["texts"] += len(texts)
+            self.stats["batches"] += 1
+            self.stats["max_batch_jobs"] = max(self.stats["max_batch_jobs"], len(jobs))
+            self.stats["encode_time_total"] += time.time() - started
+            offset = 0
+            for job_texts, future in jobs:
+                future.set_result(vectors[offset:offset + len(job_texts)])
+                offset += len(job_texts)
+
+    def get_stats(self):
+        stats = dict(self.stats, queued=self._queue.qsize())
+        stats["avg_jobs_per_batch"] = stats["jobs"] / stats["batches"] if stats["batches"] else 0.0
+        return stats
+
+
+def get_embedding_worker():
+    """推論スレッドを取得（モデルが使えない場合は None）"""
+    global _embedding_worker
+    if _embedding_worker is None:
+        model = get_embedding_model()
+        if model is None:
+            return None
+        with _embedding_worker_lock:
+            if _embedding_worker is None:
+                _embedding_worker = EmbeddingWorker(model, EMBEDDING_BATCH_MAX_SIZE, EMBEDDING_BATCH_WAIT)
+    return _embedding_worker
+
+
+def encode_texts(texts):
+    """推論スレッドでテキストをエンコード（同時に届いた依頼とまとめて計算される）"""
+    worker = get_embedding_worker()
+    if worker is None:
+        raise Exception("Embedding model not available")
+    return worker.encode(texts)
+
+
+# クエリ埋め込みのキャッシュ。QUERY_EMBEDDING_CACHE_DIR を指定すると、
+# 同じホストのワーカー間でディスク上のキャッシュを共有する
+QUERY_EMBEDDING_CACHE_SIZE = 4096
+QUERY_EMBEDDING_CACHE_DIR = os.environ.get("QUERY_EMBEDDING_CACHE_DIR")
+# ディスク上の共有キャッシュの上限件数（1件 2KB 弱）。超えたら更新時刻の古いものから消す
+QUERY_EMBEDDING_CACHE_DISK_MAX_ENTRIES = int(os.environ.get("QUERY_EMBEDDING_CACHE_DISK_MAX_ENTRIES", "100000"))
+
+
+class QueryEmbeddingCache:
+    """正規化済みクエリテキストの埋め込みを保持する LRU キャッシュ
+
+    キーはモデル（get_embedding_model_id）とプレフィックス付きテキストのハッシュ。メモリになければディスク上の共有キャッシュを見る。
+    ディスク上のファイルは読むたびに更新時刻を新しくし、件数が disk_max_entries を超えたら
+    更新時刻の古いものから消す（件数の確認は disk_max_entries / 10 回の保存ごと）。
+    """
+
+    def __init__(self, max_size=4096, cache_dir=None, disk_max_entries=100000):
+        self.max_size = max_size
+        self.cache_dir = cache_dir
+        self.disk_max_entries = disk_max_entries
+        self._prune_interval = max(1, disk_max_entries // 10)
+        self._writes_since_prune = self._prune_interval  # 起動後最初の保存で一度確認する
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.encode_time_total = 0.0  # ミス時のエンコード時間の合計
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(text):
+        return hashlib.sha1(f"{get_embedding_model_id()}\n{text}".encode("utf-8")).hexdigest()
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.npy")
+
+    def get(self, text):
+        key = self.make_key(text)
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return vector
+        if self.cache_dir and os.path.exists(self._disk_path(key)):
+            try:
+                vector = np.load(self._disk_path(key))
+                os.utime(self._disk_path(key))
+                with self._lock:
+                    self.disk_hits += 1
+                self._store(key, vector)
+                return vector
+            except Exception as e:
+                print(f"クエリ埋め込みキャッシュの読み込みエラー: {e}")
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, text, vector, encode_time=0.0):
+        key = self.make_key(text)
+        self._store(key, vector)
+        with self._lock:
+            self.encode_time_total += encode_time
+        if self.cache_dir:
+            try:
+                _save_npy_atomic(self._disk_path(key), vector)
+            except Exception as e:
+                print(f"クエリ埋め込みキャッシュの保存エラー: {e}")
+            with self._lock:
+                self._writes_since_prune += 1
+                prune = self._writes_since_prune >= self._prune_interval
+                if prune:
+                    self._writes_since_prune = 0
+            if prune:
+                self.prune_disk()
+
+    def prune_disk(self):
+        """ディスク上のキャッシュを disk_max_entries 件まで、更新時刻の古いものから消す"""
+        try:
+            files = [(entry.stat().st_mtime, entry.path) for entry in os.scandir(self.cache_dir)
+                     if entry.name.endswith(".npy")]
+        except OSError as e:
+            print(f"クエリ埋め込みキャッシュの整理エラー: {e}")
+            return 0
+        if len(files) <= self.disk_max_entries:
+            return 0
+        files.sort()
+        removed = 0
+        for _, path in files[:len(files) - self.disk_max_entries]:
+            try:
+                os.remove(path)
+                removed += 1
+            except FileNotFoundError:
+                pass  # 他のワーカーが先に消した
+            except OSError as e:
+                print(f"クエリ埋め込みキャッシュの整理エラー: {e}")
+        return removed
+
+    def _store(self, key, vector):
+        with self._lock:
+            self._entries[key] = vector
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def get_stats(self):
+        with self._lock:
+            total = self.hits + self.disk_hits + self.misses
+            avg_encode_time = self.encode_time_total / self.misses if self.misses else 0.0
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.disk_hits) / total if total else 0.0,
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "shared_dir": self.cache_dir,
+                "disk_max_entries": self.disk_max_entries if self.cache_dir else None,
+                "avg_encode_time": avg_encode_time,
+                # ヒットした分だけ平均エンコード時間を節約したとみなす
+                "saved_encode_time": (self.hits + self.disk_hits) * avg_encode_time
+            }
+
+
+_query_embedding_cache = QueryEmbeddingCache(
+    QUERY_EMBEDDING_CACHE_SIZE, QUERY_EMBEDDING_CACHE_DIR, QUERY_EMBEDDING_CACHE_DISK_MAX_ENTRIES
+)
+
+
+def encode_queries(normalized_inputs):
+    """正規化済みクエリの埋め込み（L2正規化済み）を返す。キャッシュにないものだけをまとめてエンコードする"""
+    texts = [f"query: {t}" for t in normalized_inputs]
+    vectors = [_query_embedding_cache.get(text) for text in texts]
+    missing = [i for i, v in enumerate(vectors) if v is None]
+    if missing:
+        started = time.time()
+        encoded = l2_normalize(encode_texts([texts[i] for i in missing]))
+        encode_time = (time.time() - started) / len(missing)
+        for i, vector in zip(missing, encoded):
+            _query_embedding_cache.put(texts[i], vector, encode_time)
+            vectors[i] = vector
+    return np.vstack(vectors) if vectors else np.zeros((0, 0), dtype=np.float32)
+
+
+def l2_normalize(vectors):
+    """行ベクトルをL2正規化（float32）"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def _save_npy_atomic(path, array):
+    """一時ファイルに書いてから置き換える（一時ファイル名は書き込みごとに一意なので同時に書いても壊れない）"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, array)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
 def load_synthetic_embeddings():
-    """事前計算済みの合成データ埋め込みをロード"""
+    """事前計算済みの合成データ埋め込みをロード
+
+    行列は構築時にL2正規化して保存し、mmap_mode で開く。
+    Gunicornの各ワーカーはページキャッシュを共有するため、プロセスごとのコピーが発生しない。
+    計算したモデル（EMBEDDINGS_META_FILE）が今のモデルと異なる場合は使わない（呼び出し側で作り直す）。
+    """
     global _synthetic_embeddings, _synthetic_ids
     
     if _synthetic_embeddings is not None:
         return _synthetic_embeddings, _synthetic_ids
     
     if os.path.exists(EMBEDDINGS_CACHE_FILE) and os.path.exists(EMBEDDINGS_IDS_FILE):
+        cached_model = f"{EMBEDDING_MODEL_NAME}:sentence_transformers"
+        if os.path.exists(EMBEDDINGS_META_FILE):
+            with open(EMBEDDINGS_META_FILE, "r", encoding="utf-8") as f:
+                cached_model = json.load(f).get("embedding_model")
+        if cached_model != get_embedding_model_id():
+            print(f"Embeddings cache was computed with {cached_model}, needs recomputing")
+            return None, None
         try:
-            _synthetic_embeddings = np.load(EMBEDDINGS_CACHE_FILE)
+            embeddings = np.load(EMBEDDINGS_CACHE_FILE, mmap_mode="r")
+            # 旧形式（未正規化）のキャッシュは一度だけ正規化して書き戻す
+            sample_norms = np.linalg.norm(embeddings[:100], axis=1)
+            if embeddings.dtype != np.float32 or not np.allclose(sample_norms, 1.0, atol=1e-3):
+                print("Normalizing legacy embeddings cache...")
+                normalized = l2_normalize(embeddings)
+                del embeddings
+                _save_npy_atomic(EMBEDDINGS_CACHE_FILE, normalized)
+                embeddings = np.load(EMBEDDINGS_CACHE_FILE, mmap_mode="r")
             with open(EMBEDDINGS_IDS_FILE, "r", encoding="utf-8") as f:
                 _synthetic_ids = json.load(f)
+            _synthetic_embeddings = embeddings
             print(f"Loaded {len(_synthetic_ids)} pre-computed embeddings from cache")
             return _synthetic_embeddings, _synthetic_ids
         except Exception as e:
@@ -268,7 +984,7 @@ def load_synthetic_embeddings():
 
 def compute_and_cache_synthetic_embeddings():
     """合成データの埋め込みを計算してキャッシュに保存"""
-    global _synthetic_embeddings, _synthetic_ids
+    global _synthetic_embeddings, _synthetic_ids, _ann_index
     
     model = get_embedding_model()
     if model is None:
@@ -286,57 +1002,557 @@ def compute_and_cache_synthetic_embeddings():
     texts = [f"passage: {normalize_text(r['text'])}" for r in records]
     ids = [r.get("id", f"case_{i}") for i, r in enumerate(records)]
     
-    # バッチで埋め込みを計算
-    embeddings = model.encode(texts, batch_size=32, show_progress_bar=True, convert_to_numpy=True)
+    # 推論スレッドで計算し、検索時に内積だけで済むよう正規化しておく
+    embeddings = l2_normalize(encode_texts(texts))
     
     # キャッシュに保存
     os.makedirs(os.path.dirname(EMBEDDINGS_CACHE_FILE), exist_ok=True)
-    np.save(EMBEDDINGS_CACHE_FILE, embeddings)
+    _save_npy_atomic(EMBEDDINGS_CACHE_FILE, embeddings)
     with open(EMBEDDINGS_IDS_FILE, "w", encoding="utf-8") as f:
         json.dump(ids, f, ensure_ascii=False)
+    with open(EMBEDDINGS_META_FILE, "w", encoding="utf-8") as f:
+        json.dump({"embedding_model": get_embedding_model_id(), "count": len(ids)}, f, ensure_ascii=False)
+    
+    # 古いANNインデックスは破棄する
+    _ann_index = (None, None, None)
+    if os.path.exists(ANN_INDEX_FILE):
+        os.remove(ANN_INDEX_FILE)
     
-    _synthetic_embeddings = embeddings
-    _synthetic_ids = ids
+    # メモリ上のコピーは捨てて mmap で開き直し、ANNインデックスは開き直したファイルに対して作る
+    _synthetic_embeddings = None
+    _synthetic_ids = None
+    embeddings, _ = load_synthetic_embeddings()
+    if embeddings is not None:
+        get_ann_index(embeddings, build=True)
     
     print(f"Saved {len(ids)} embeddings to cache")
     return True
 
 
-def compute_tfidf_similarities(normalized_input, records):
-    """TF-IDF類似度を計算するヘルパー関数"""
-    if not records:
-        return np.array([])
-    
-    corpus = [normalize_text(r["text"]) for r in records]
-    corpus.append(normalized_input)
-    
-    vectorizer = TfidfVectorizer(
-        analyzer='char',
-        ngram_range=(2, 5),
-        max_features=5000,
-        min_df=1,
-        max_df=0.95
+def start_synthetic_embedding_build():
+    """合成データの埋め込み計算をバックグラウンドで開始（実行中なら何もしない）"""
+    global _synthetic_embedding_thread
+    with _embedding_worker_lock:
+        if _synthetic_embedding_thread is None or not _synthetic_embedding_thread.is_alive():
+            _synthetic_embedding_thread = threading.Thread(target=compute_and_cache_synthetic_embeddings, daemon=True)
+            _synthetic_embedding_thread.start()
+
+
+def embeddings_source_key(embeddings):
+    """mmap で開いた埋め込みの元ファイルを表すキー (パス, 更新時刻, 形)（メモリ上の配列は None）"""
+    path = getattr(embeddings, "filename", None)
+    if not path or not os.path.exists(path):
+        return None
+    return (os.path.abspath(path), os.stat(path).st_mtime_ns, tuple(embeddings.shape))
+
+
+def cached_for_embeddings(cache, embeddings):
+    """(元の埋め込み行列, 元ファイルのキー, 値) のキャッシュが embeddings から作ったものなら値を返す
+
+    元の行列への参照を持つので、解放された行列と同じ id の別の行列を取り違えることはない。
+    """
+    source, key, value = cache
+    if source is embeddings or (key is not None and key == embeddings_source_key(embeddings)):
+        return value
+    return None
+
+
+def _ann_index_meta_path():
+    """HNSWインデックスをどの埋め込みから作ったか（元ファイルのキー）を記録するファイル"""
+    return ANN_INDEX_FILE + ".json"
+
+
+def build_ann_index(embeddings):
+    """正規化済み埋め込みからHNSWインデックスを構築して保存
+
+    書き込み途中のファイルを他のワーカーが読まないよう、一時ファイルに保存してから置き換える。
+    """
+    global _ann_index
+    key = embeddings_source_key(embeddings)
+    num_elements, dim = embeddings.shape
+    started = time.time()
+    print(f"Building HNSW index for {num_elements} embeddings...")
+    index = hnswlib.Index(space="ip", dim=dim)
+    index.init_index(max_elements=num_elements, ef_construction=ANN_EF_CONSTRUCTION, M=ANN_M)
+    index.add_items(np.asarray(embeddings, dtype=np.float32), np.arange(num_elements))
+
+    ann_dir = os.path.dirname(ANN_INDEX_FILE) or "."
+    os.makedirs(ann_dir, exist_ok=True)
+    prefix = f".{os.path.basename(ANN_INDEX_FILE)}."
+    fd, tmp_path = tempfile.mkstemp(dir=ann_dir, prefix=prefix, suffix=".tmp")
+    os.close(fd)
+    try:
+        index.save_index(tmp_path)
+        os.replace(tmp_path, ANN_INDEX_FILE)
+        # 元ファイルのキーは本体の後に書くので、本体だけが新しい間は一致せず読み込まれない
+        fd, tmp_path = tempfile.mkstemp(dir=ann_dir, prefix=prefix, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"source": list(key) if key else None}, f, ensure_ascii=False)
+        os.replace(tmp_path, _ann_index_meta_path())
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    index.set_ef(ANN_EF_SEARCH)
+    _ann_index = (embeddings, key, index)
+    print(f"Built HNSW index in {time.time() - started:.2f}s")
+    return index
+
+
+def load_ann_index(embeddings):
+    """保存済みのHNSWインデックスを読む（無い・別の埋め込みから作った・件数が違う場合は None）"""
+    key = embeddings_source_key(embeddings)
+    if key is None or not os.path.exists(ANN_INDEX_FILE) or not os.path.exists(_ann_index_meta_path()):
+        return None
+    try:
+        with open(_ann_index_meta_path(), "r", encoding="utf-8") as f:
+            source = json.load(f).get("source")
+        if source is None or (source[0], source[1], tuple(source[2])) != key:
+            print("HNSW index was built from other embeddings, needs rebuilding")
+            return None
+        num_elements, dim = embeddings.shape
+        index = hnswlib.Index(space="ip", dim=dim)
+        index.load_index(ANN_INDEX_FILE, max_elements=num_elements)
+        if index.get_current_count() != num_elements:
+            return None
+        index.set_ef(ANN_EF_SEARCH)
+        return index
+    except Exception as e:
+        print(f"Failed to load HNSW index: {e}")
+        return None
+
+
+def start_ann_index_build(embeddings):
+    """HNSWインデックスの構築をバックグラウンドで開始（実行中なら何もしない）"""
+    global _ann_index_thread
+    with _embedding_worker_lock:
+        if _ann_index_thread is None or not _ann_index_thread.is_alive():
+            _ann_index_thread = threading.Thread(target=build_ann_index, args=(embeddings,), daemon=True)
+            _ann_index_thread.start()
+
+
+def get_ann_index(embeddings, build=False):
+    """embeddings のHNSWインデックスを取得（件数が少ない・ライブラリ未導入の場合は None）
+
+    保存済みのインデックスが無い・古い場合、build=True（ウォームアップ・事前構築）ならその場で作る。
+    検索リクエストからの呼び出しではバックグラウンドで作り始めて None を返す（その間は全件を走査する）。
+    """
+    global _ann_index
+    if not HNSWLIB_AVAILABLE or embeddings is None or len(embeddings) < ANN_INDEX_MIN_SIZE:
+        return None
+    index = cached_for_embeddings(_ann_index, embeddings)
+    if index is not None:
+        return index
+    with _ann_index_lock:
+        index = cached_for_embeddings(_ann_index, embeddings)
+        if index is None:
+            index = load_ann_index(embeddings)
+            if index is not None:
+                _ann_index = (embeddings, embeddings_source_key(embeddings), index)
+    if index is not None:
+        return index
+    if build:
+        return build_ann_index(embeddings)
+    start_ann_index_build(embeddings)
+    return None
+
+
+def quantize_embeddings(embeddings, mode):
+    """正規化済み埋め込みを量子化して (行列, 行ごとのスケール) を返す
+
+    float16 はそのまま半精度に、int8 は行ごとの最大絶対値で [-127, 127] に割り当てる。
+    """
+    if mode == "float16":
+        return np.asarray(embeddings, dtype=np.float16), None
+    if mode == "int8":
+        codes = np.empty(embeddings.shape, dtype=np.int8)
+        scales = np.empty(len(embeddings), dtype=np.float32)
+        for start in range(0, len(embeddings), QUANTIZED_SCAN_CHUNK):
+            block = np.asarray(embeddings[start:start + QUANTIZED_SCAN_CHUNK], dtype=np.float32)
+            block_scales = np.abs(block).max(axis=1) / 127.0
+            block_scales[block_scales == 0] = 1.0
+            codes[start:start + len(block)] = np.round(block / block_scales[:, None])
+            scales[start:start + len(block)] = block_scales
+        return codes, scales
+    raise ValueError(f"未対応の量子化方式です: {mode}")
+
+
+def quantized_dot(codes, scales, query_embedding):
+    """量子化した行列とクエリの内積（チャンクごとに float32 に戻して計算）
+
+    query_embedding に (次元数, クエリ数) の行列を渡すと、全クエリ分を (行数, クエリ数) で返す。
+    """
+    scores = np.empty((len(codes),) + query_embedding.shape[1:], dtype=np.float32)
+    for start in range(0, len(codes), QUANTIZED_SCAN_CHUNK):
+        block = codes[start:start + QUANTIZED_SCAN_CHUNK].astype(np.float32)
+        scores[start:start + len(block)] = block @ query_embedding
+    if scales is not None:
+        scores *= scales.reshape((-1,) + (1,) * (scores.ndim - 1))
+    return scores
+
+
+def quantized_embeddings_paths(embeddings_path, mode):
+    """量子化した埋め込みの保存先 (行列, 行ごとのスケール)（元の .npy と同じディレクトリ）"""
+    base, ext = os.path.splitext(embeddings_path)
+    return f"{base}_{mode}{ext}", f"{base}_{mode}_scales{ext}"
+
+
+def load_quantized_embeddings(embeddings_path, shape, mode):
+    """保存済みの量子化埋め込みを mmap で開く（無い・元の埋め込みより古い・形が違う場合は None）"""
+    codes_path, scales_path = quantized_embeddings_paths(embeddings_path, mode)
+    paths = [codes_path, scales_path] if mode == "int8" else [codes_path]
+    if not all(os.path.exists(p) for p in paths):
+        return None
+    source_mtime = os.path.getmtime(embeddings_path)
+    if any(os.path.getmtime(p) < source_mtime for p in paths):
+        return None
+    try:
+        codes = np.load(codes_path, mmap_mode="r")
+        scales = np.load(scales_path, mmap_mode="r") if mode == "int8" else None
+    except (OSError, ValueError) as e:
+        print(f"Failed to load quantized embeddings: {e}")
+        return None
+    if codes.shape != tuple(shape) or (scales is not None and scales.shape != (shape[0],)):
+        return None
+    return codes, scales
+
+
+def get_quantized_embeddings(embeddings):
+    """EMBEDDING_QUANTIZATION に従って量子化した埋め込みを取得
+
+    mmap で開いた埋め込みの場合は、量子化した行列とスケールを元の .npy の隣に保存して mmap で開き直す。
+    各ワーカーはページキャッシュを共有し、次回の起動からは量子化し直さない。
+    """
+    global _quantized_embeddings
+    quantized = cached_for_embeddings(_quantized_embeddings, embeddings)
+    if quantized is not None:
+        return quantized
+
+    mode = EMBEDDING_QUANTIZATION
+    source = getattr(embeddings, "filename", None)
+    quantized = load_quantized_embeddings(source, embeddings.shape, mode) if source else None
+    if quantized is None:
+        started = time.time()
+        quantized = quantize_embeddings(embeddings, mode)
+        print(f"Quantized {len(embeddings)} embeddings to {mode} in {time.time() - started:.2f}s")
+        if source:
+            codes_path, scales_path = quantized_embeddings_paths(source, mode)
+            try:
+                # 行列を最後に書くので、行列が新しければスケールも揃っている
+                if quantized[1] is not None:
+                    _save_npy_atomic(scales_path, quantized[1])
+                _save_npy_atomic(codes_path, quantized[0])
+                quantized = load_quantized_embeddings(source, embeddings.shape, mode) or quantized
+            except OSError as e:
+                print(f"Failed to save quantized embeddings: {e}")
+    _quantized_embeddings = (embeddings, embeddings_source_key(embeddings), quantized)
+    return quantized
+
+
+def search_quantized_embeddings(query_embedding, embeddings, codes, scales, candidates=QUANTIZED_RERANK_CANDIDATES,
+                                approx_sims=None):
+    """量子化した埋め込みで全件を走査し、上位候補だけ float32 で再計算して (行インデックス, 類似度) を返す
+
+    ANNと同じく候補の行だけを返す。近似値の類似度はハイブリッドのスコアの正規化に入らない。
+    approx_sims（quantized_dot で計算済みの近似類似度）を渡すと走査を省略する（バッチ検索用）。
+    """
+    sims = quantized_dot(codes, scales, query_embedding) if approx_sims is None else approx_sims
+    if len(sims) > candidates:
+        rows = np.argpartition(-sims, candidates - 1)[:candidates]
+        rows.sort()  # mmap 上の読み出しを連続させる
+    else:
+        rows = np.arange(len(sims))
+    return rows, np.asarray(embeddings[rows], dtype=np.float32) @ query_embedding
+
+
+def search_synthetic_embeddings(query_embedding, embeddings, rows=None):
+    """合成データの埋め込みとの類似度を (行インデックス, 類似度) で返す
+
+    ANNインデックスがあれば上位 ANN_CANDIDATES 件のみ、量子化が有効なら量子化行列で走査した
+    上位候補のみ、どちらもなければ全件を内積で計算する。
+    rows（絞り込み後の行）を渡した場合は、その行だけを正確に計算する。
+    """
+    if rows is not None:
+        return rows, embeddings[rows] @ query_embedding
+    ann_index = get_ann_index(embeddings)
+    if ann_index is not None:
+        k = min(ANN_CANDIDATES, len(embeddings))
+        labels, distances = ann_index.knn_query(query_embedding.reshape(1, -1), k=k)
+        # space="ip" の距離は 1 - 内積
+        return labels[0].astype(np.int64), 1.0 - distances[0]
+    if EMBEDDING_QUANTIZATION != "none":
+        codes, scales = get_quantized_embeddings(embeddings)
+        return search_quantized_embeddings(query_embedding, embeddings, codes, scales)
+    return np.arange(len(embeddings)), embeddings @ query_embedding
+
+
+def batch_embedding_similarities(index, records, active, query_embeddings, exact=False):
+    """バッチ検索の1チャンク分のセマンティック類似度を (類似度, scored) の (クエリ数, レコード数) 行列で返す
+
+    DBレコード・合成データの埋め込みとの内積は、それぞれ全クエリ分を1回の行列積（E @ Q.T）で計算する。
+    exact=False の場合は search_synthetic_embeddings と同じく、ANNインデックスがあれば1回の knn_query、
+    量子化が有効なら1回の走査で候補を選ぶ。exact=True（絞り込みあり）は active の行だけを正確に計算する。
+    """
+    model = get_embedding_model()
+    synthetic_embeddings, synthetic_ids = load_synthetic_embeddings()
+    alignment = get_hybrid_alignment(index, records, synthetic_ids)
+    is_db = alignment["is_db"]
+    num_queries = len(query_embeddings)
+    sims = np.zeros((num_queries, len(records)))
+    scored = np.zeros((num_queries, len(records)), dtype=bool)
+
+    db_idx = np.flatnonzero(is_db & active)
+    if db_idx.size:
+        db_embeddings = get_db_record_embeddings(model, [records[i] for i in db_idx])
+        sims[:, db_idx] = (db_embeddings @ query_embeddings.T).T
+        scored[:, db_idx] = True
+
+    if synthetic_embeddings is None or len(synthetic_embeddings) == 0:
+        return sims, scored
+    emb_row_to_record = alignment["emb_row_to_record"]
+    ann_index = None if exact else get_ann_index(synthetic_embeddings)
+    if ann_index is not None:
+        k = min(ANN_CANDIDATES, len(synthetic_embeddings))
+        labels, distances = ann_index.knn_query(query_embeddings, k=k)
+        record_idx = emb_row_to_record[labels.astype(np.int64)]
+        query_idx = np.broadcast_to(np.arange(num_queries)[:, None], labels.shape)
+        valid = record_idx >= 0
+        # space="ip" の距離は 1 - 内積
+        sims[query_idx[valid], record_idx[valid]] = 1.0 - distances[valid]
+        scored[query_idx[valid], record_idx[valid]] = True
+    elif not exact and EMBEDDING_QUANTIZATION != "none":
+        codes, scales = get_quantized_embeddings(synthetic_embeddings)
+        approx = quantized_dot(codes, scales, query_embeddings.T)
+        for q, query_embedding in enumerate(query_embeddings):
+            # 走査はまとめて1回、上位候補の float32 での再計算だけクエリごとに行う
+            rows, candidate_sims = search_quantized_embeddings(
+                query_embedding, synthetic_embeddings, codes, scales, approx_sims=approx[:, q]
+            )
+            record_idx = emb_row_to_record[rows]
+            valid = record_idx >= 0
+            sims[q, record_idx[valid]] = candidate_sims[valid]
+            scored[q, record_idx[valid]] = True
+    else:
+        rows = np.flatnonzero(emb_row_to_record >= 0)
+        rows = rows[active[emb_row_to_record[rows]]]
+        block = synthetic_embeddings if rows.size == len(synthetic_embeddings) else synthetic_embeddings[rows]
+        record_idx = emb_row_to_record[rows]
+        sims[:, record_idx] = (block @ query_embeddings.T).T
+        scored[:, record_idx] = True
+    return sims, scored
+
+
+def db_record_content_hash(normalized_text):
+    """DBレコードの埋め込みキャッシュ用の内容ハッシュ（モデルとバックエンドを含める）"""
+    return hashlib.sha1(f"{get_embedding_model_id()}\n{normalized_text}".encode("utf-8")).hexdigest()
+
+
+def load_db_record_embeddings():
+    """ディスクに永続化したDBレコード埋め込みキャッシュをロード"""
+    global _db_record_embeddings
+    if _db_record_embeddings is not None:
+        return _db_record_embeddings
+
+    cache = {}
+    if os.path.exists(DB_EMBEDDINGS_CACHE_FILE):
+        try:
+            with np.load(DB_EMBEDDINGS_CACHE_FILE) as data:
+                for record_id, content_hash, embedding in zip(data["ids"], data["hashes"], data["embeddings"]):
+                    cache[int(record_id)] = (str(content_hash), embedding)
+            print(f"Loaded {len(cache)} DB record embeddings from cache")
+        except Exception as e:
+            print(f"Failed to load DB record embeddings cache: {e}")
+    _db_record_embeddings = cache
+    return _db_record_embeddings
+
+
+def save_db_record_embeddings():
+    """DBレコード埋め込みキャッシュをディスクに保存
+
+    一時ファイルはプロセスごとに一意な名前で作るため、複数のワーカーが同時に保存しても
+    互いの書きかけのファイルを上書きしない（os.replace で最後に書いた方が残る）。
+    """
+    cache = load_db_record_embeddings()
+    with _db_embeddings_lock:
+        items = sorted(cache.items())
+    if not items:
+        return
+    ids = np.array([record_id for record_id, _ in items], dtype=np.int64)
+    hashes = np.array([content_hash for _, (content_hash, _) in items])
+    embeddings = np.vstack([embedding for _, (_, embedding) in items]).astype(np.float32)
+
+    cache_dir = os.path.dirname(DB_EMBEDDINGS_CACHE_FILE)
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix=".db_embeddings.", suffix=".npz")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, ids=ids, hashes=hashes, embeddings=embeddings)
+        os.replace(tmp_path, DB_EMBEDDINGS_CACHE_FILE)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def _save_db_record_embeddings_in_background():
+    global _db_embeddings_save_timer
+    with _db_embeddings_save_lock:
+        # 書き出し中に追加された分は次の保存で書くよう、先に予約を外す
+        _db_embeddings_save_timer = None
+    try:
+        save_db_record_embeddings()
+    except Exception as e:
+        print(f"Failed to save DB record embeddings cache: {e}")
+
+
+def schedule_db_record_embeddings_save():
+    """DBレコード埋め込みキャッシュの保存を予約する
+
+    ファイル全体の書き直しはリクエストの外（タイマースレッド）で行い、
+    DB_EMBEDDINGS_SAVE_DELAY 秒以内に続いた更新は1回の書き出しにまとめる。
+    """
+    global _db_embeddings_save_timer
+    with _db_embeddings_save_lock:
+        if _db_embeddings_save_timer is None:
+            _db_embeddings_save_timer = threading.Timer(DB_EMBEDDINGS_SAVE_DELAY, _save_db_record_embeddings_in_background)
+            _db_embeddings_save_timer.daemon = True
+            _db_embeddings_save_timer.start()
+
+
+def _encode_db_records(model, db_records, texts, hashes):
+    """キャッシュにない・内容が変わったレコードだけをエンコードしてキャッシュに反映"""
+    cache = load_db_record_embeddings()
+    missing = [
+        i for i, (r, h) in enumerate(zip(db_records, hashes))
+        if cache.get(r["id"], (None,))[0] != h
+    ]
+    if not missing:
+        return
+    encoded = l2_normalize(encode_texts([f"passage: {texts[i]}" for i in missing]))
+    with _db_embeddings_lock:
+        for i, embedding in zip(missing, encoded):
+            cache[db_records[i]["id"]] = (hashes[i], embedding)
+    schedule_db_record_embeddings_save()
+
+
+def upsert_db_record_embeddings(records):
+    """DBレコードの埋め込みを計算してキャッシュに反映（モデルがロード済みの場合のみ）"""
+    model = _embedding_model
+    if model is None or not records:
+        return
+    texts = [normalize_text(r["text"]) for r in records]
+    hashes = [db_record_content_hash(t) for t in texts]
+    _encode_db_records(model, records, texts, hashes)
+
+
+def get_db_record_embeddings(model, db_records):
+    """DBレコードの埋め込み行列を取得
+
+    visit_record_id と内容ハッシュをキーにしたキャッシュを使い、新規・変更レコードのみエンコードする。
+    結果は db_records の順に並べた連続配置の float32 行列として保持し、並びが変わらない限り再利用する。
+    """
+    global _db_embedding_matrix
+    texts = [normalize_text(r["text"]) for r in db_records]
+    hashes = [db_record_content_hash(t) for t in texts]
+    key = tuple(zip((r["id"] for r in db_records), hashes))
+
+    cached_key, cached_matrix = _db_embedding_matrix
+    if cached_key == key:
+        return cached_matrix
+
+    _encode_db_records(model, db_records, texts, hashes)
+    cache = load_db_record_embeddings()
+    matrix = np.ascontiguousarray(np.vstack([cache[r["id"]][1] for r in db_records]), dtype=np.float32)
+    _db_embedding_matrix = (key, matrix)
+    return matrix
+
+
+# ハイブリッドスコアリングの重み
+ALPHA_EMBEDDING = 0.5  # セマンティック類似度の重み
+ALPHA_TFIDF = 0.35     # TF-IDF類似度の重み
+ALPHA_KEYWORD = 0.15   # キーワード重複の重み
+
+_hybrid_alignment_cache = (None, None)
+
+
+def get_hybrid_alignment(index, records, synthetic_ids):
+    """index.records の並びに揃えた補助配列を取得（コーパスの版ごとに一度だけ作る）
+
+    - is_db: システム入力のレコードか
+    - emb_row_to_record: 合成データ埋め込みの行 -> レコード位置（該当なしは -1）
+    - record_to_emb_row: レコード位置 -> 合成データ埋め込みの行（該当なしは -1）
+    """
+    global _hybrid_alignment_cache
+    key = (index.version, len(records), id(synthetic_ids))
+    cached_key, cached = _hybrid_alignment_cache
+    if cached_key == key:
+        return cached
+
+    is_db = np.fromiter((r.get("source") == "システム入力" for r in records), dtype=bool, count=len(records))
+    id_to_record_idx = {r.get("id", f"case_{i}"): i for i, r in enumerate(records) if not is_db[i]}
+    emb_row_to_record = np.fromiter(
+        (id_to_record_idx.get(case_id, -1) for case_id in (synthetic_ids or [])),
+        dtype=np.int64, count=len(synthetic_ids or [])
     )
-    tfidf_matrix = vectorizer.fit_transform(corpus)
-    
-    input_vector = tfidf_matrix[-1]
-    doc_vectors = tfidf_matrix[:-1]
-    
-    return cosine_similarity(input_vector, doc_vectors)[0]
+    record_to_emb_row = np.full(len(records), -1, dtype=np.int64)
+    mapped = emb_row_to_record >= 0
+    record_to_emb_row[emb_row_to_record[mapped]] = np.flatnonzero(mapped)
+    alignment = {
+        "is_db": is_db,
+        "emb_row_to_record": emb_row_to_record,
+        "record_to_emb_row": record_to_emb_row
+    }
+    _hybrid_alignment_cache = (key, alignment)
+    return alignment
 
 
-def compute_keyword_overlap(record, query_keywords):
-    """キーワードの重複度を計算"""
-    case_keywords = set(record.get("difficulty_keywords", [])) | set(record.get("support_keywords", []))
-    if not case_keywords or not query_keywords:
-        return 0
-    overlap = len(case_keywords & set(query_keywords))
-    # 正規化: 最大5キーワードの重複で1.0
-    return min(overlap / 5.0, 1.0)
+def top_k_by_score(scores, candidates, k):
+    """候補インデックスのうちスコア上位 k 件を降順で返す（argpartition で部分選択）"""
+    if len(candidates) > k:
+        candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
 
 
-def search_similar_embeddings(normalized_input, records, keywords):
-    """ハイブリッド類似事例検索（セマンティック + TF-IDF + キーワード重複）"""
+class StageTimer:
+    """検索の段階ごとの所要時間をミリ秒で積算する
+
+    段階は embed（クエリの埋め込み）/ retrieve（絞り込み・一次検索）/ score（類似度）/ rank（上位の選択）/
+    format（表示用の結果の作成）/ serialise（レスポンスの JSON への変換）/ cache（検索結果キャッシュの参照）。
+    lap(stage) を呼ぶと、前回の lap（または作成時）からの経過時間を stage に加える。
+    """
+
+    def __init__(self):
+        self.timings = {}
+        self._started = self._last = time.perf_counter()
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        self.timings[stage] = self.timings.get(stage, 0.0) + (now - self._last) * 1000
+        self._last = now
+
+    def summary(self):
+        timings = {stage: round(ms, 2) for stage, ms in self.timings.items()}
+        timings["total"] = round((self._last - self._started) * 1000, 2)
+        return timings
+
+
+def search_similar_embeddings(normalized_input, records, keywords, index=None, mask=None, query_embedding=None,
+                              first_stage=None, weights=None, timer=None, tfidf_result=None, embedding_result=None):
+    """ハイブリッド類似事例検索（セマンティック + TF-IDF + キーワード重複）
+
+    3種類のスコアを index.records に揃えた配列として計算し、NumPy の配列演算で合成する。
+    上位の選択は argpartition で行い、結果の辞書は最終的に返す事例の分だけ作る。
+    mask（build_search_mask の戻り値）を渡すと該当する事例だけを対象にする。
+    query_embedding（正規化済み）を渡すとクエリのエンコードを省略する（バッチ検索用）。
+    tfidf_result（index.query_batch の1クエリ分の (records, 類似度, active)）を渡すと
+    TF-IDF類似度の計算を省略する（バッチ検索用）。mask はこの場合も絞り込みの有無の判定に使う。
+    embedding_result（batch_embedding_similarities の1クエリ分の (類似度, scored)）を渡すと
+    セマンティック類似度の計算を省略する（バッチ検索用）。
+    first_stage="bm25"（省略時は SEARCH_FIRST_STAGE）の場合は BM25 の上位候補だけを対象にする。
+    weights は (セマンティック, TF-IDF, キーワード) の重み（省略時は ALPHA_*）。重みが 0 のスコアは計算しない。
+    timer（StageTimer）を渡すと段階ごとの所要時間を記録する。
+    """
+    alpha_embedding, alpha_tfidf, alpha_keyword = weights or (ALPHA_EMBEDDING, ALPHA_TFIDF, ALPHA_KEYWORD)
+    timer = timer or StageTimer()
     model = get_embedding_model()
     if model is None:
         raise Exception("Embedding model not available")
@@ -344,185 +1560,208 @@ def search_similar_embeddings(normalized_input, records, keywords):
     # 合成データの埋め込みをロード
     synthetic_embeddings, synthetic_ids = load_synthetic_embeddings()
     
-    # キャッシュがない場合は計算
+    # キャッシュがない場合は全件のエンコードに時間がかかるため、リクエスト内では待たずに
+    # バックグラウンドで計算を始める
     if synthetic_embeddings is None:
-        if not compute_and_cache_synthetic_embeddings():
-            raise Exception("Failed to compute synthetic embeddings")
-        synthetic_embeddings, synthetic_ids = load_synthetic_embeddings()
+        start_synthetic_embedding_build()
+        raise Exception("合成データの埋め込みを計算中です")
     
     # 入力テキストの埋め込みを計算（E5モデル用にquery:プレフィックス）
-    query_embedding = model.encode(f"query: {normalized_input}", convert_to_numpy=True)
+    if query_embedding is None:
+        query_embedding = encode_queries([normalized_input])[0]
+    timer.lap("embed")
     
-    # DBレコードとPDF事例集を分離
-    db_records = [r for r in records if r.get("source") == "システム入力"]
-    synthetic_records = [r for r in records if r.get("source") != "システム入力"]
+    # TF-IDF類似度（常駐インデックスがなければこのレコードで構築）
+    if index is None:
+        index = TfidfSearchIndex(records)
+    if tfidf_result is not None:
+        # バッチ検索では query_batch で計算済みの1行分を使う
+        records, tfidf_sims, active = tfidf_result
+        if (first_stage or SEARCH_FIRST_STAGE) == "bm25":
+            mask = active = index.bm25_candidates(normalized_input, mask=active)[:len(records)]
+        timer.lap("retrieve")
+    else:
+        if (first_stage or SEARCH_FIRST_STAGE) == "bm25":
+            mask = index.bm25_candidates(normalized_input, mask=mask)
+        timer.lap("retrieve")
+        if alpha_tfidf:
+            records, tfidf_sims, active = index.query(normalized_input, mask=mask)
+        else:
+            records, active = index.active_rows(mask)
+            tfidf_sims = 0.0
+    alignment = get_hybrid_alignment(index, records, synthetic_ids)
+    is_db = alignment["is_db"]
     
-    # ハイブリッドスコアリングの重み
-    ALPHA_EMBEDDING = 0.5  # セマンティック類似度の重み
-    ALPHA_TFIDF = 0.35     # TF-IDF類似度の重み
-    ALPHA_KEYWORD = 0.15   # キーワード重複の重み
+    # セマンティック類似度（正規化済みなので内積）。スコアを持つレコードだけを scored で示す
+    if embedding_result is not None:
+        embedding_sims, scored = embedding_result
+        scored = scored & active
+    else:
+        embedding_sims = np.zeros(len(records))
+        scored = np.zeros(len(records), dtype=bool)
     
-    results = []
-    all_scores = []  # スコア正規化用
+    db_idx = np.flatnonzero(is_db & active) if embedding_result is None else np.empty(0, dtype=np.int64)
+    if db_idx.size:
+        db_embeddings = get_db_record_embeddings(model, [records[i] for i in db_idx])
+        embedding_sims[db_idx] = db_embeddings @ query_embedding
+        scored[db_idx] = True
     
-    # DBレコードの処理
-    if db_records:
-        db_texts = [f"passage: {normalize_text(r['text'])}" for r in db_records]
-        db_embeddings = model.encode(db_texts, batch_size=32, convert_to_numpy=True)
-        
-        # セマンティック類似度
-        db_embedding_sims = cosine_similarity([query_embedding], db_embeddings)[0]
-        
-        # TF-IDF類似度
-        db_tfidf_sims = compute_tfidf_similarities(normalized_input, db_records)
-        
-        for i in range(len(db_records)):
-            embedding_sim = float(db_embedding_sims[i])
-            tfidf_sim = float(db_tfidf_sims[i]) if i < len(db_tfidf_sims) else 0
-            keyword_sim = compute_keyword_overlap(db_records[i], keywords)
-            
-            # ハイブリッドスコア
-            combined_score = (
-                ALPHA_EMBEDDING * embedding_sim +
-                ALPHA_TFIDF * tfidf_sim +
-                ALPHA_KEYWORD * keyword_sim
-            )
-            
-            all_scores.append(combined_score)
-            display_text = db_records[i].get("display_text", db_records[i]["text"])
-            results.append({
-                "raw_score": combined_score,
-                "embedding_sim": embedding_sim,
-                "tfidf_sim": tfidf_sim,
-                "keyword_sim": keyword_sim,
-                "text": display_text[:500],
-                "policy": db_records[i]["policy"][:500] if db_records[i]["policy"] else "支援方針未登録",
-                "client_id": db_records[i].get("client_id"),
-                "source": "システム入力"
-            })
-    
-    # 合成データの処理
-    if synthetic_embeddings is not None and len(synthetic_embeddings) > 0:
-        # セマンティック類似度
-        synthetic_embedding_sims = cosine_similarity([query_embedding], synthetic_embeddings)[0]
-        
-        # TF-IDF類似度（合成データ全体に対して計算）
-        synthetic_tfidf_sims = compute_tfidf_similarities(normalized_input, synthetic_records)
-        
-        # IDからレコードとインデックスを検索するためのマップを作成
-        id_to_record_idx = {r.get("id", f"case_{i}"): (i, r) for i, r in enumerate(synthetic_records)}
-        
-        for emb_idx, case_id in enumerate(synthetic_ids):
-            if case_id in id_to_record_idx:
-                record_idx, record = id_to_record_idx[case_id]
-                
-                embedding_sim = float(synthetic_embedding_sims[emb_idx])
-                tfidf_sim = float(synthetic_tfidf_sims[record_idx]) if record_idx < len(synthetic_tfidf_sims) else 0
-                keyword_sim = compute_keyword_overlap(record, keywords)
-                
-                # ハイブリッドスコア
-                combined_score = (
-                    ALPHA_EMBEDDING * embedding_sim +
-                    ALPHA_TFIDF * tfidf_sim +
-                    ALPHA_KEYWORD * keyword_sim
-                )
-                
-                all_scores.append(combined_score)
-                display_text = record.get("display_text", record["text"])
-                result = {
-                    "raw_score": combined_score,
-                    "embedding_sim": embedding_sim,
-                    "tfidf_sim": tfidf_sim,
-                    "keyword_sim": keyword_sim,
-                    "text": display_text[:500],
-                    "policy": record["policy"][:500] if record["policy"] else "支援方針未登録",
-                    "client_id": None,
-                    "source": record.get("source", "合成データ")
-                }
-                if record.get("difficulty_keywords"):
-                    result["difficulty_keywords"] = record["difficulty_keywords"]
-                if record.get("support_keywords"):
-                    result["support_keywords"] = record["support_keywords"]
-                results.append(result)
-    
-    # スコアを正規化して表示用の類似度に変換
-    if all_scores:
-        min_score = min(all_scores)
-        max_score = max(all_scores)
-        score_range = max_score - min_score if max_score > min_score else 1
-        
-        for result in results:
-            # 正規化スコア（0-100%）
-            normalized = (result["raw_score"] - min_score) / score_range
-            # 表示用に40-100%の範囲にマッピング（より直感的な表示）
-            display_score = 40 + normalized * 60
-            result["similarity"] = float(round(display_score, 1))
+    if embedding_result is None and synthetic_embeddings is not None and len(synthetic_embeddings) > 0:
+        # ANNインデックスがあれば候補のみ。絞り込み時は該当する行だけを計算する
+        rows = None
+        if mask is not None:
+            rows = alignment["record_to_emb_row"][np.flatnonzero(active & ~is_db)]
+            rows = np.sort(rows[rows >= 0])
+        candidate_rows, candidate_sims = search_synthetic_embeddings(query_embedding, synthetic_embeddings, rows)
+        record_idx = alignment["emb_row_to_record"][candidate_rows]
+        valid = record_idx >= 0
+        embedding_sims[record_idx[valid]] = candidate_sims[valid]
+        scored[record_idx[valid]] = True
     
-    # 結果をソートしてシステム入力と合成データのバランスを取る
-    sorted_results = sorted(results, key=lambda x: x["raw_score"], reverse=True)
+    scored &= active
+    scored_idx = np.flatnonzero(scored)
+    if scored_idx.size == 0:
+        return []
     
-    db_results = [r for r in sorted_results if r["source"] == "システム入力"][:3]
-    synthetic_results = [r for r in sorted_results if r["source"] != "システム入力"][:10]
+    keyword_sims = index.keywords.overlaps(keywords, len(records)) if alpha_keyword else 0.0
     
-    combined_results = db_results + synthetic_results
-    final_results = sorted(combined_results, key=lambda x: x["raw_score"], reverse=True)[:10]
+    # ハイブリッドスコア
+    combined_scores = (
+        alpha_embedding * embedding_sims +
+        alpha_tfidf * tfidf_sims +
+        alpha_keyword * keyword_sims
+    )
+    timer.lap("score")
     
-    # デバッグ情報を削除
-    for result in final_results:
-        result.pop("raw_score", None)
-        result.pop("embedding_sim", None)
-        result.pop("tfidf_sim", None)
-        result.pop("keyword_sim", None)
+    # スコアを正規化して表示用の類似度（40-100%）に変換する基準
+    min_score = combined_scores[scored_idx].min()
+    max_score = combined_scores[scored_idx].max()
+    score_range = max_score - min_score if max_score > min_score else 1
+    
+    # システム入力は最大3件、合成データは最大10件を選び、その中から上位10件
+    db_top = top_k_by_score(combined_scores, scored_idx[is_db[scored_idx]], 3)
+    synthetic_top = top_k_by_score(combined_scores, scored_idx[~is_db[scored_idx]], 10)
+    final_idx = top_k_by_score(combined_scores, np.concatenate([db_top, synthetic_top]), 10)
+    timer.lap("rank")
+    
+    final_results = []
+    for i in final_idx:
+        record = records[i]
+        normalized = (combined_scores[i] - min_score) / score_range
+        result = {
+            "similarity": float(round(40 + normalized * 60, 1)),
+            "text": get_display_text(record)[:500],
+            "policy": record["policy"][:500] if record["policy"] else "支援方針未登録",
+            "client_id": record.get("client_id") if is_db[i] else None,
+            "source": "システム入力" if is_db[i] else record.get("source", "合成データ")
+        }
+        if not is_db[i]:
+            if record.get("difficulty_keywords"):
+                result["difficulty_keywords"] = record["difficulty_keywords"]
+            if record.get("support_keywords"):
+                result["support_keywords"] = record["support_keywords"]
+        final_results.append(result)
+    timer.lap("format")
     
     return final_results
 
 
-def search_similar_tfidf(normalized_input, records, keywords):
-    """TF-IDFベースの類似事例検索（フォールバック用）"""
-    corpus = [normalize_text(r["text"]) for r in records]
-    corpus.append(normalized_input)
-    
-    vectorizer = TfidfVectorizer(
-        analyzer='char',
-        ngram_range=(2, 5),
-        max_features=5000,
-        min_df=1,
-        max_df=0.95
-    )
-    tfidf_matrix = vectorizer.fit_transform(corpus)
-    
-    input_vector = tfidf_matrix[-1]
-    doc_vectors = tfidf_matrix[:-1]
-    
-    similarities = cosine_similarity(input_vector, doc_vectors)[0]
-    
+def search_similar_tfidf(normalized_input, records, keywords, index=None, mask=None, first_stage=None, timer=None):
+    """TF-IDFベースの類似事例検索（フォールバック用）
+
+    index が渡された場合は常駐インデックスの学習済みベクトライザを使い、
+    クエリの transform だけで類似度を計算する。
+    mask（build_search_mask の戻り値）を渡すと該当する事例だけを対象にする。
+    first_stage="bm25"（省略時は SEARCH_FIRST_STAGE）の場合は BM25 の上位候補だけを対象にする。
+    timer（StageTimer）を渡すと段階ごとの所要時間を記録する。
+    """
+    timer = timer or StageTimer()
+    if index is None:
+        index = TfidfSearchIndex(records)
+    if (first_stage or SEARCH_FIRST_STAGE) == "bm25":
+        mask = index.bm25_candidates(normalized_input, mask=mask)
+    timer.lap("retrieve")
+    records, similarities, _ = index.query(normalized_input, mask=mask)
+    timer.lap("score")
+    return build_tfidf_results(index, records, similarities, timer)
+
+
+def search_similar_bm25(normalized_input, records, keywords, index=None, mask=None, timer=None):
+    """BM25（文字バイグラムの転置インデックス）だけで順位付けする類似事例検索
+
+    クエリと一致したポスティングの分だけ計算するため、全件の行列積が要らず最も軽い。
+    表示する類似度は、上位候補の最大スコアを 100% とした割合。
+    """
+    timer = timer or StageTimer()
+    if index is None:
+        index = TfidfSearchIndex(records)
+    records, docs, scores = index.bm25_search(normalized_input, mask=mask)
+    timer.lap("score")
+
+    order = np.argsort(-scores, kind="stable")
+    selected = select_balanced_top(docs[order], records)
+    max_score = scores[order[0]] if len(order) and scores[order[0]] > 0 else 1.0
+    similarities = np.zeros(len(records))
+    similarities[docs] = scores / max_score
+    timer.lap("rank")
+    return serialize_search_results(records, selected, similarities, timer)
+
+
+def build_tfidf_results(index, records, similarities, timer=None):
+    """TF-IDF類似度の配列から表示用の検索結果を作る"""
+    timer = timer or StageTimer()
+    # 表示する類似度（%）の降順の候補から、システム入力は最大3件・事例集は最大10件を選ぶ
+    order = index.top_candidates(similarities)
+    selected = select_balanced_top(order, records)
+    timer.lap("rank")
+    return serialize_search_results(records, selected, similarities, timer)
+
+
+def serialize_search_results(records, selected, similarities, timer=None):
+    """選んだ行の表示用の検索結果を作る（similarities は 0-1 の類似度の配列）"""
+    # 表示用の結果は最終的に返す事例の分だけ作る
     results = []
-    for i, sim in enumerate(similarities):
-        if sim > 0.01:
-            display_text = records[i].get("display_text", records[i]["text"])
-            
-            result = {
-                "similarity": round(sim * 100, 1),
-                "text": display_text[:500],
-                "policy": records[i]["policy"][:500] if records[i]["policy"] else "支援方針未登録",
-                "client_id": records[i].get("client_id"),
-                "source": records[i].get("source", "不明")
-            }
-            if records[i].get("difficulty_keywords"):
-                result["difficulty_keywords"] = records[i]["difficulty_keywords"]
-            if records[i].get("support_keywords"):
-                result["support_keywords"] = records[i]["support_keywords"]
-            results.append(result)
-    
-    sorted_results = sorted(results, key=lambda x: x["similarity"], reverse=True)
-    
-    db_results = [r for r in sorted_results if r["source"] == "システム入力"][:3]
-    synthetic_results = [r for r in sorted_results if r["source"] != "システム入力"][:10]
-    
-    combined_results = db_results + synthetic_results
-    final_results = sorted(combined_results, key=lambda x: x["similarity"], reverse=True)[:10]
+    for i in selected:
+        display_text = get_display_text(records[i])
+        
+        result = {
+            "similarity": round(float(similarities[i]) * 100, 1),
+            "text": display_text[:500],
+            "policy": records[i]["policy"][:500] if records[i]["policy"] else "支援方針未登録",
+            "client_id": records[i].get("client_id"),
+            "source": records[i].get("source", "不明")
+        }
+        if records[i].get("difficulty_keywords"):
+            result["difficulty_keywords"] = records[i]["difficulty_keywords"]
+        if records[i].get("support_keywords"):
+            result["support_keywords"] = records[i]["support_keywords"]
+        results.append(result)
+    if timer is not None:
+        timer.lap("format")
     
-    return final_results
+    return results
+
+
+def select_balanced_top(order, records, db_limit=3, other_limit=10, top_k=10):
+    """スコア降順のインデックス列から、システム入力最大 db_limit 件と
+    その他最大 other_limit 件のうちスコア上位 top_k 件を返す"""
+    selected = []
+    db_count = 0
+    other_count = 0
+    for i in order:
+        if records[i].get("source") == "システム入力":
+            if db_count >= db_limit:
+                continue
+            db_count += 1
+        else:
+            if other_count >= other_limit:
+                continue
+            other_count += 1
+        # order は降順なので、選んだ順がそのままスコア順になる
+        selected.append(i)
+        if len(selected) >= top_k:
+            break
+    return selected
 
 
 # 書き方の差異を吸収するための同義語マッピング
@@ -562,14 +1801,58 @@ SYNONYM_MAP = {
     "短期入所": "ショートステイ利用",
 }
 
+# 同義語マップを上書き・追加するファイル（{"表記ゆれ": "正規形"} のJSON、任意）
+SYNONYM_MAP_FILE = os.path.join(os.path.dirname(__file__), "data", "synonyms.json")
+NORMALIZE_CACHE_SIZE = 65536  # 文書ごとの正規化結果を保持する件数
+
+_synonym_pattern = None
+_synonym_replacements = {}
+
+
+def compile_synonym_map(synonym_map):
+    """同義語マップを1パスで置換する正規表現にコンパイル
+
+    長い語を優先して照合する。正規形自身も恒等置換として登録し、
+    「デイサービス導入」が「デイサービス導入導入」になるような二重置換を防ぐ。
+    """
+    global _synonym_pattern, _synonym_replacements
+    replacements = {canonical: canonical for canonical in synonym_map.values()}
+    replacements.update(synonym_map)
+    terms = sorted(replacements, key=len, reverse=True)
+    _synonym_pattern = re.compile("|".join(re.escape(t) for t in terms)) if terms else None
+    _synonym_replacements = replacements
+    _normalize_text_cached.cache_clear()
+
+
+def load_synonym_map(path=SYNONYM_MAP_FILE):
+    """組み込みの同義語マップにファイルの定義を重ねてコンパイル"""
+    synonym_map = dict(SYNONYM_MAP)
+    if path and os.path.exists(path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                synonym_map.update(json.load(f))
+            print(f"Loaded synonym map from {path}")
+        except Exception as e:
+            print(f"同義語マップの読み込みエラー: {e}")
+    compile_synonym_map(synonym_map)
+    return synonym_map
+
+
+@functools.lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
+def _normalize_text_cached(text):
+    if _synonym_pattern is None:
+        return text
+    return _synonym_pattern.sub(lambda m: _synonym_replacements[m.group(0)], text)
+
+
 def normalize_text(text):
-    """テキストを正規化して書き方の差異を吸収"""
+    """テキストを正規化して書き方の差異を吸収（1パス置換、文書ごとにメモ化）"""
     if not text:
         return ""
-    normalized = text
-    for variant, canonical in SYNONYM_MAP.items():
-        normalized = normalized.replace(variant, canonical)
-    return normalized
+    return _normalize_text_cached(text)
+
+
+load_synonym_map()
 
 def extract_keywords(text, top_n=10):
     """テキストからキーワードを抽出（TF-IDF上位語）"""
@@ -589,17 +1872,26 @@ def extract_keywords(text, top_n=10):
     return [w[0] for w in sorted_words[:top_n]]
 
 
-def get_visit_records_for_tfidf():
-    """DBから訪問記録を取得してTF-IDF用のドキュメントを作成"""
+def get_visit_records_for_tfidf(client_id=None):
+    """DBから訪問記録を取得してTF-IDF用のドキュメントを作成
+
+    client_id を指定した場合はその利用者の訪問記録のみを返す。
+    """
     records = []
     
+    client_filter = ""
+    params = ()
+    if client_id is not None:
+        client_filter = "AND client_id = %s"
+        params = (client_id,)
+    
     try:
         conn = get_connection()
         
         with conn:
             with conn.cursor() as cur:
                 # 実際のカラム名に合わせて修正
-                cur.execute("""
+                cur.execute(f"""
                     SELECT 
                         visit_record_id,
                         client_id,
@@ -617,12 +1909,13 @@ def get_visit_records_for_tfidf():
                         COALESCE(vr_disability_adl, '') as disability_adl,
                         COALESCE(vr_other, '') as other_notes
                     FROM visit_record
-                    WHERE vr_reaction IS NOT NULL AND vr_reaction != ''
+                    WHERE (vr_reaction IS NOT NULL AND vr_reaction != ''
                        OR vr_cognition IS NOT NULL AND vr_cognition != ''
                        OR vr_behavior IS NOT NULL AND vr_behavior != ''
                        OR vr_physical IS NOT NULL AND vr_physical != ''
-                       OR vr_living IS NOT NULL AND vr_living != ''
-                """)
+                       OR vr_living IS NOT NULL AND vr_living != '')
+                       {client_filter}
+                """, params)
                 rows = cur.fetchall()
                 
                 for row in rows:
@@ -648,7 +1941,11 @@ def get_visit_records_for_tfidf():
                             "client_id": row["client_id"],
                             "text": combined_text,
                             "policy": str(row.get("judgment", "")),
-                            "source": "システム入力"
+                            "source": "システム入力",
+                            "metadata": {
+                                "dementia_adl": row.get("dementia_adl") or None,
+                                "disability_adl": row.get("disability_adl") or None
+                            }
                         })
     except Exception as e:
         print(f"データベースからの訪問記録取得エラー: {e}")
@@ -657,40 +1954,156 @@ def get_visit_records_for_tfidf():
     return records
 
 
+def convert_case_corpus(case_file=None):
+    """cases.json を検索用・表示用の JSON Lines ストアに変換
+
+    検索用ストアには検索で使う項目（visit_like_text, policy, キーワード）だけを1行1件で書き出し、
+    ナラティブ形式の表示用テキストは別ファイルに置いて、そのバイト位置を検索用レコードに持たせる。
+    """
+    case_file = case_file or CASE_STUDIES_FILE
+    with open(case_file, "r", encoding="utf-8") as f:
+        data = json.load(f)
+
+    # 一時ファイルは同じディレクトリに一意な名前で作る（複数ワーカーが同時に変換しても衝突しない）
+    search_fd, search_tmp = tempfile.mkstemp(
+        dir=os.path.dirname(CASE_SEARCH_STORE_FILE),
+        prefix=f".{os.path.basename(CASE_SEARCH_STORE_FILE)}.", suffix=".tmp")
+    display_fd, display_tmp = tempfile.mkstemp(
+        dir=os.path.dirname(CASE_DISPLAY_STORE_FILE),
+        prefix=f".{os.path.basename(CASE_DISPLAY_STORE_FILE)}.", suffix=".tmp")
+    try:
+        count = _write_case_stores(data, search_fd, display_fd)
+        os.replace(display_tmp, CASE_DISPLAY_STORE_FILE)
+        os.replace(search_tmp, CASE_SEARCH_STORE_FILE)
+    except BaseException:
+        for tmp_path in (search_tmp, display_tmp):
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        raise
+    print(f"Converted {count} cases to {CASE_SEARCH_STORE_FILE}")
+    return count
+
+
+def _write_case_stores(data, search_fd, display_fd):
+    """検索用・表示用ストアを開いたファイル記述子に書き出し、件数を返す"""
+    count = 0
+    with open(search_fd, "w", encoding="utf-8") as search_out, open(display_fd, "wb") as display_out:
+        # 先頭行は形式のヘッダー
+        search_out.write(json.dumps({"format": CASE_STORE_FORMAT}) + "\n")
+        for case in data.get("cases", []):
+            display_offset = display_out.tell()
+            display_line = json.dumps({"id": case.get("id", ""), "text": case.get("text", "")}, ensure_ascii=False)
+            display_out.write(display_line.encode("utf-8") + b"\n")
+
+            # TF-IDF用テキスト: visit_like_textがあればそれを使用、なければtextを使用
+            # visit_like_textは訪問記録表と同じ構造のテキストで、TF-IDFマッチングに最適化
+            search_record = {
+                "id": case.get("id", ""),
+                "text": case.get("visit_like_text", case.get("text", "")),
+                "policy": case.get("policy", ""),
+                "source": case.get("source", "PDF事例集"),
+                "difficulty_keywords": case.get("difficulty_keywords", []),
+                "support_keywords": case.get("support_keywords", []),
+                "metadata": case.get("metadata", {}),
+                "display_offset": display_offset
+            }
+            search_out.write(json.dumps(search_record, ensure_ascii=False, separators=(",", ":")) + "\n")
+            count += 1
+    return count
+
+
+def _read_case_store_format():
+    try:
+        with open(CASE_SEARCH_STORE_FILE, "r", encoding="utf-8") as f:
+            return json.loads(f.readline()).get("format")
+    except Exception:
+        return None
+
+
+def _case_store_is_stale():
+    source_mtime = os.path.getmtime(CASE_STUDIES_FILE)
+    return (not os.path.exists(CASE_SEARCH_STORE_FILE)
+            or not os.path.exists(CASE_DISPLAY_STORE_FILE)
+            or os.path.getmtime(CASE_SEARCH_STORE_FILE) < source_mtime
+            or _read_case_store_format() != CASE_STORE_FORMAT)
+
+
+def ensure_case_store():
+    """検索用ストアが無い・cases.json より古い・形式が古い場合は変換する
+
+    変換はファイルロックでワーカー間で1つに絞り、ロック取得後に改めて要否を確認する。
+    変換に失敗しても、既にあるストア（他のワーカーが書いたものを含む）があればそれを使う。
+    """
+    if os.path.exists(CASE_STUDIES_FILE) and _case_store_is_stale():
+        lock_file = None
+        try:
+            if fcntl is not None:
+                lock_file = open(CASE_STORE_LOCK_FILE, "w")
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if _case_store_is_stale():
+                convert_case_corpus()
+        except Exception as e:
+            print(f"事例集ストアの変換エラー: {e}")
+        finally:
+            if lock_file is not None:
+                lock_file.close()
+    return os.path.exists(CASE_SEARCH_STORE_FILE)
+
+
+_case_records_cache = (None, [])  # (検索用ストアの更新時刻, レコード一覧)
+_case_records_lock = threading.Lock()
+_case_records_failed = False  # 直近の読み込みが失敗したか（インデックスの再構築判定に使う）
+
+
 def get_pdf_case_studies():
-    """PDF事例集からのデータを取得"""
-    case_file = os.path.join(os.path.dirname(__file__), "data", "case_studies", "cases.json")
-    
-    if not os.path.exists(case_file):
-        return []
+    """PDF事例集からのデータを取得
+
+    検索用ストアを1行ずつ読み込み、プロセス内で保持する（ストアが更新されたら読み直す）。
+    表示用テキストは get_display_text で必要な事例の分だけ取得する。
+    """
+    global _case_records_cache, _case_records_failed
     
     try:
-        with open(case_file, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        
-        records = []
-        for case in data.get("cases", []):
-            # TF-IDF用テキスト: visit_like_textがあればそれを使用、なければtextを使用
-            # visit_like_textは訪問記録表と同じ構造のテキストで、TF-IDFマッチングに最適化
-            tfidf_text = case.get("visit_like_text", case.get("text", ""))
+        with _case_records_lock:
+            if not ensure_case_store():
+                _case_records_failed = os.path.exists(CASE_STUDIES_FILE)
+                return []
             
-            records.append({
-                "id": case.get("id", ""),
-                "client_id": None,
-                "text": tfidf_text,  # TF-IDF用（訪問記録表形式）
-                "display_text": case.get("text", ""),  # 表示用（ナラティブ形式）
-                "policy": case.get("policy", ""),
-                "source": case.get("source", "PDF事例集"),
-                "difficulty_keywords": case.get("difficulty_keywords", []),
-                "support_keywords": case.get("support_keywords", [])
-            })
-        
-        return records
+            mtime = os.path.getmtime(CASE_SEARCH_STORE_FILE)
+            cached_mtime, cached_records = _case_records_cache
+            if cached_mtime == mtime:
+                return cached_records
+            
+            records = []
+            with open(CASE_SEARCH_STORE_FILE, "r", encoding="utf-8") as f:
+                f.readline()  # ヘッダー行
+                for line in f:
+                    record = json.loads(line)
+                    record["client_id"] = None
+                    records.append(record)
+            _case_records_cache = (mtime, records)
+            _case_records_failed = False
+            return records
     except Exception as e:
         print(f"PDF事例集の読み込みエラー: {e}")
+        _case_records_failed = True
         return []
 
 
+def get_display_text(record):
+    """表示用テキストを取得（事例集は表示用ストアから該当行だけを読む）"""
+    display_offset = record.get("display_offset")
+    if display_offset is None:
+        return record.get("display_text", record["text"])
+    try:
+        with open(CASE_DISPLAY_STORE_FILE, "rb") as f:
+            f.seek(display_offset)
+            return json.loads(f.readline())["text"] or record["text"]
+    except Exception as e:
+        print(f"表示用テキストの読み込みエラー: {e}")
+        return record["text"]
+
+
 def get_all_records_for_tfidf():
     """DBの訪問記録とPDF事例集を統合して取得"""
     db_records = get_visit_records_for_tfidf()
@@ -698,31 +2111,1216 @@ def get_all_records_for_tfidf():
     return db_records + pdf_records
 
 
+# ---- 常駐TF-IDFインデックス ----
+# ベクトライザと文書行列（CSR）を一度だけ学習してメモリに保持し、
+# 検索時はクエリの transform のみを行う。
+# cases.json または visit_record テーブルの変更を検知するとバックグラウンドで再構築する。
+
+TFIDF_INDEX_CHECK_INTERVAL = 5.0  # 変更検知の間隔（秒）
+TFIDF_DELTA_COMPACT_THRESHOLD = 500  # 差分行がこれを超えたら再構築して詰め直す
+# 類似度計算を行方向に分割してスレッドで並列に行う分割数（CPUコア数程度）。
+# 文書数が TFIDF_SHARD_MIN_ROWS 未満の分割は行わない
+TFIDF_SCORING_SHARDS = int(os.environ.get("TFIDF_SCORING_SHARDS", "1"))
+TFIDF_SHARD_MIN_ROWS = 20000
+# 特徴抽出の方式（"tfidf": 語彙を学習する TfidfVectorizer / "hashing": 語彙を持たない HashingVectorizer + IDF）
+TFIDF_FEATURE_EXTRACTOR = os.environ.get("TFIDF_FEATURE_EXTRACTOR", "tfidf")
+TFIDF_HASH_FEATURES = int(os.environ.get("TFIDF_HASH_FEATURES", str(2 ** 18)))  # ハッシュの次元数
+TFIDF_HASH_FIT_CHUNK = 1000  # 学習時に一度に変換する文書数（n-gram の一時文字列はこの件数分だけ）
+
+_tfidf_index = None
+_tfidf_index_lock = threading.Lock()
+_tfidf_rebuild_thread = None
+_tfidf_last_check = 0.0
+# コーパスが変わるたびに進む版番号（検索結果キャッシュの無効化に使う）
+_corpus_version_counter = itertools.count(1)
+_scoring_pool = (None, None, 0)  # (プロセスID, ThreadPoolExecutor, スレッド数)
+_scoring_pool_lock = threading.Lock()
+
+
+def get_scoring_pool(num_threads):
+    """分割スコアリング用のスレッドプール（fork後・スレッド数が足りない場合は作り直す）"""
+    global _scoring_pool
+    with _scoring_pool_lock:
+        pid, pool, size = _scoring_pool
+        if pid != os.getpid() or pool is None or size < num_threads:
+            pool = ThreadPoolExecutor(max_workers=num_threads, thread_name_prefix="tfidf-shard")
+            _scoring_pool = (os.getpid(), pool, num_threads)
+        return pool
+
+
+class KeywordIndex:
+    """事例 × キーワードの出現行列（CSR）
+
+    語彙は合成データ生成の困難・支援キーワードに、事例集から抽出されたキーワードを加えたもの。
+    キーワード重複度は疎行列とクエリベクトルの積1回で全事例分を計算できる。
+    """
+
+    def __init__(self, records, vocabulary=None, matrix=None):
+        if vocabulary is not None:
+            # 保存済みの語彙と行列から復元
+            self.vocabulary = vocabulary
+            self.matrix = matrix.tocsr()
+            return
+        vocabulary = {}
+        for keyword in DIFFICULTY_KEYWORDS + SUPPORT_KEYWORDS:
+            vocabulary.setdefault(keyword, len(vocabulary))
+        for r in records:
+            for keyword in itertools.chain(r.get("difficulty_keywords", []), r.get("support_keywords", [])):
+                vocabulary.setdefault(keyword, len(vocabulary))
+        self.vocabulary = vocabulary
+        self.matrix = self._build_rows(records)
+
+    def _build_rows(self, records):
+        indptr = [0]
+        indices = []
+        for r in records:
+            columns = {
+                self.vocabulary[k]
+                for k in itertools.chain(r.get("difficulty_keywords", []), r.get("support_keywords", []))
+                if k in self.vocabulary
+            }
+            indices.extend(sorted(columns))
+            indptr.append(len(indices))
+        return sp.csr_matrix(
+            (np.ones(len(indices), dtype=np.float32), np.array(indices, dtype=np.int32), np.array(indptr, dtype=np.int64)),
+            shape=(len(records), len(self.vocabulary))
+        )
+
+    def append(self, records):
+        """行を追加（語彙にないキーワードは無視する）"""
+        if records:
+            self.matrix = sp.vstack([self.matrix, self._build_rows(records)]).tocsr()
+
+    def query_vector(self, keywords):
+        vector = np.zeros(len(self.vocabulary), dtype=np.float32)
+        for keyword in keywords or []:
+            j = self.vocabulary.get(keyword)
+            if j is not None:
+                vector[j] = 1.0
+        return vector
+
+    def overlaps(self, keywords, num_rows):
+        """先頭 num_rows 件の事例とのキーワード重複度（最大5キーワードの重複で1.0）"""
+        counts = self.matrix[:num_rows] @ self.query_vector(keywords)
+        return np.minimum(counts / 5.0, 1.0)
+
+    def filter_rows(self, required_keywords, num_rows):
+        """指定キーワードをすべて含む事例を示すブール配列（AND 条件）"""
+        columns = [self.vocabulary.get(k) for k in required_keywords]
+        if any(j is None for j in columns):
+            return np.zeros(num_rows, dtype=bool)
+        counts = np.asarray(self.matrix[:num_rows][:, columns].sum(axis=1)).ravel()
+        return counts == len(columns)
+
+
+# 事例メタデータの絞り込みに使う項目。順序のある項目は "IIb-IIIa" のような範囲指定ができる
+METADATA_FILTER_FIELDS = [
+    "gender", "living_situation", "dementia_type", "care_level",
+    "dementia_adl", "disability_adl", "outcome"
+]
+METADATA_ORDINAL_LEVELS = {
+    "care_level": CARE_LEVELS,
+    "dementia_adl": DEMENTIA_ADL_LEVELS,
+    "disability_adl": DISABILITY_ADL_LEVELS,
+}
+
+
+class MetadataIndex:
+    """事例メタデータの絞り込み用インデックス
+
+    カテゴリ項目は値ごとのビットマップ（ブール配列）、年齢は並べ替え済み配列で保持し、
+    スコア計算の前に対象事例を決める。
+    """
+
+    def __init__(self, records):
+        self.size = 0
+        self.bitmaps = {field: {} for field in METADATA_FILTER_FIELDS}
+        self.ages = np.zeros(0)
+        self.append(records)
+
+    def append(self, records):
+        """行を追加"""
+        start = self.size
+        total = start + len(records)
+        for field, bitmaps in self.bitmaps.items():
+            for value, bitmap in list(bitmaps.items()):
+                bitmaps[value] = np.concatenate([bitmap, np.zeros(len(records), dtype=bool)])
+            for i, r in enumerate(records):
+                value = (r.get("metadata") or {}).get(field)
+                if value is None or value == "":
+                    continue
+                if value not in bitmaps:
+                    bitmaps[value] = np.zeros(total, dtype=bool)
+                bitmaps[value][start + i] = True
+
+        new_ages = [(r.get("metadata") or {}).get("age") for r in records]
+        self.ages = np.concatenate([self.ages, np.array([np.nan if a is None else a for a in new_ages], dtype=float)])
+        # 年齢の範囲検索用（NaN は末尾に並ぶ）。検索中の参照と食い違わないよう (並び順, 並べ替えた年齢) を一度に差し替える
+        age_order = np.argsort(self.ages, kind="stable")
+        self.age_index = (age_order, self.ages[age_order])
+        self.size = total
+
+    @staticmethod
+    def resolve_values(field, condition):
+        """条件（値・値のリスト・順序項目の範囲指定）を該当する値の一覧にする"""
+        conditions = condition if isinstance(condition, list) else [condition]
+        levels = METADATA_ORDINAL_LEVELS.get(field)
+        values = []
+        for c in conditions:
+            c = str(c).strip()
+            bounds = re.split(r"\s*[-–〜~]\s*", c) if levels else [c]
+            if len(bounds) == 2 and bounds[0] in levels and bounds[1] in levels:
+                lo, hi = sorted((levels.index(bounds[0]), levels.index(bounds[1])))
+                values.extend(levels[lo:hi + 1])
+            else:
+                values.append(c)
+        return values
+
+    def filter_rows(self, filters, num_rows):
+        """絞り込み条件をすべて満たす先頭 num_rows 件の事例を示すブール配列
+
+        filters の例: {"living_situation": "独居", "dementia_adl": "IIb-IIIa", "age_min": 75}
+        """
+        mask = np.ones(num_rows, dtype=bool)
+        for field, condition in filters.items():
+            if field in ("age_min", "age_max"):
+                continue
+            if field not in self.bitmaps:
+                raise ValueError(f"未対応の絞り込み項目です: {field}")
+            field_mask = np.zeros(num_rows, dtype=bool)
+            for value in self.resolve_values(field, condition):
+                bitmap = self.bitmaps[field].get(value)
+                if bitmap is not None:
+                    field_mask |= bitmap[:num_rows]
+            mask &= field_mask
+
+        if "age_min" in filters or "age_max" in filters:
+            age_order, sorted_ages = self.age_index
+            lo = np.searchsorted(sorted_ages, float(filters.get("age_min", -np.inf)), side="left")
+            hi = np.searchsorted(sorted_ages, float(filters.get("age_max", np.inf)), side="right")
+            rows = age_order[lo:hi]
+            age_mask = np.zeros(num_rows, dtype=bool)
+            age_mask[rows[rows < num_rows]] = True
+            mask &= age_mask
+        return mask
+
+
+# BM25 による一次検索（"none" / "bm25"）。bm25 の場合は文字バイグラムの転置インデックスで
+# 上位 BM25_CANDIDATES 件に絞ってから、TF-IDF・埋め込みの類似度を計算する
+SEARCH_FIRST_STAGE = os.environ.get("SEARCH_FIRST_STAGE", "none")
+BM25_CANDIDATES = 300
+BM25_K1 = 1.2
+BM25_B = 0.75
+# 一致したポスティングが文書数の 1/BM25_SPARSE_POSTINGS_RATIO 未満なら、一致した文書だけを並べ替えて合計する。
+# それ以上なら全文書分の配列に足し込む方が速い（10万件で 6千件: 0.32ms 対 0.41ms、830万件: 683ms 対 177ms）
+BM25_SPARSE_POSTINGS_RATIO = 16
+
+
+def char_bigram_keys(text):
+    """文字バイグラムを整数キー（前の文字のコードポイント << 21 | 後の文字）の配列にする"""
+    codes = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+    return (codes[:-1] << np.uint64(21)) | codes[1:]
+
+
+class BM25Index:
+    """文字バイグラムの転置インデックス（BM25）
+
+    語ごとのポスティング（文書番号と、IDF を掛けた BM25 の重み）を CSR と同じ形の配列で持つ。
+    語はバイグラムの整数キーを並べた配列を二分探索して引くため、語彙の辞書は持たない。
+    クエリのコストは一致したポスティングの数に比例する。
+    """
+
+    def __init__(self, term_keys, indptr, doc_ids, weights, num_docs, avgdl=None):
+        self.term_keys = term_keys
+        self.indptr = indptr
+        self.doc_ids = doc_ids
+        self.weights = weights
+        self.num_docs = num_docs
+        self.avgdl = avgdl
+
+    @classmethod
+    def build(cls, corpus, k1=BM25_K1, b=BM25_B, reference=None):
+        """corpus の BM25 インデックスを作る
+
+        reference（学習時の BM25Index）を渡すと、IDF と平均文書長は reference の統計を使う。
+        学習後に追加された差分行のスコアを学習時の文書と比べられるようにするため。
+        """
+        keys = [char_bigram_keys(text) for text in corpus]
+        lengths = np.array([len(k) for k in keys], dtype=np.float64)
+        docs = np.repeat(np.arange(len(corpus), dtype=np.int32), lengths.astype(np.int64))
+        keys = np.concatenate(keys) if keys else np.zeros(0, dtype=np.uint64)
+
+        # (語, 文書) の組ごとの出現回数
+        order = np.lexsort((docs, keys))
+        keys, docs = keys[order], docs[order]
+        new_pair = np.ones(len(keys), dtype=bool)
+        new_pair[1:] = (keys[1:] != keys[:-1]) | (docs[1:] != docs[:-1])
+        pair_starts = np.flatnonzero(new_pair)
+        tf = np.diff(np.append(pair_starts, len(keys))).astype(np.float64)
+        pair_keys, pair_docs = keys[pair_starts], docs[pair_starts]
+
+        # 語ごとのポスティングの範囲
+        new_term = np.ones(len(pair_keys), dtype=bool)
+        new_term[1:] = pair_keys[1:] != pair_keys[:-1]
+        term_starts = np.flatnonzero(new_term)
+        indptr = np.append(term_starts, len(pair_keys)).astype(np.int64)
+        document_frequency = np.diff(indptr)
+
+        avgdl = lengths.mean() if len(lengths) and lengths.mean() > 0 else 1.0
+        num_docs = len(corpus)
+        term_keys = pair_keys[term_starts]
+        if reference is not None:
+            num_docs = reference.num_docs
+            document_frequency = reference.document_frequency(term_keys)
+            avgdl = reference.avgdl or avgdl
+        idf = np.log(1 + (num_docs - document_frequency + 0.5) / (document_frequency + 0.5))
+        tf_weight = tf * (k1 + 1) / (tf + k1 * (1 - b + b * lengths[pair_docs] / avgdl))
+        weights = (tf_weight * np.repeat(idf, np.diff(indptr))).astype(np.float32)
+        return cls(term_keys, indptr, pair_docs, weights, len(corpus), float(avgdl))
+
+    def document_frequency(self, keys):
+        """語（バイグラムの整数キー）ごとの文書頻度（インデックスに無い語は 0）"""
+        positions = np.minimum(np.searchsorted(self.term_keys, keys), max(len(self.term_keys) - 1, 0))
+        if len(self.term_keys) == 0:
+            return np.zeros(len(keys), dtype=np.int64)
+        found = self.term_keys[positions] == keys
+        return np.where(found, self.indptr[positions + 1] - self.indptr[positions], 0)
+
+    def save(self, path):
+        np.savez_compressed(
+            path, term_keys=self.term_keys, indptr=self.indptr, doc_ids=self.doc_ids,
+            weights=self.weights, num_docs=self.num_docs, avgdl=self.avgdl or 0.0
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            avgdl = float(data["avgdl"]) if "avgdl" in data.files else None
+            return cls(data["term_keys"], data["indptr"], data["doc_ids"], data["weights"], int(data["num_docs"]),
+                       avgdl or None)
+
+    def search(self, text, k, mask=None):
+        """BM25 スコア上位 k 件の (文書番号, スコア) を返す（mask があれば該当する文書のみ）"""
+        query_keys = np.unique(char_bigram_keys(text))
+        positions = np.searchsorted(self.term_keys, query_keys)
+        in_range = positions < len(self.term_keys)
+        positions, query_keys = positions[in_range], query_keys[in_range]
+        # 索引に無い語は挿入位置が隣の語を指すので、キーが一致する位置だけを使う
+        terms = positions[self.term_keys[positions] == query_keys]
+        if terms.size == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+
+        # 一致した語のポスティングをまとめて取り出して文書ごとに合計する
+        starts, ends = self.indptr[terms], self.indptr[terms + 1]
+        sizes = ends - starts
+        offsets = np.repeat(starts - np.cumsum(sizes) + sizes, sizes) + np.arange(sizes.sum())
+        docs, weights = self.doc_ids[offsets], self.weights[offsets]
+        if docs.size * BM25_SPARSE_POSTINGS_RATIO < self.num_docs:
+            # 一致した文書だけを文書番号で並べて合計する（語の順序を保つので合計の順序も全文書分の場合と同じ）
+            if mask is not None:
+                keep = mask[docs]
+                docs, weights = docs[keep], weights[keep]
+            if docs.size == 0:
+                return np.zeros(0, dtype=np.int64), np.zeros(0)
+            order = np.argsort(docs, kind="stable")
+            docs, weights = docs[order], weights[order].astype(np.float64)
+            doc_starts = np.flatnonzero(np.concatenate([[True], docs[1:] != docs[:-1]]))
+            docs, scores = docs[doc_starts].astype(np.int64), np.add.reduceat(weights, doc_starts)
+        else:
+            scores = np.bincount(docs, weights=weights, minlength=self.num_docs)
+            if mask is not None:
+                scores[~mask] = 0.0
+            # BM25 の重みは正なので、スコアが正の文書が一致した文書
+            docs = np.flatnonzero(scores > 0)
+            scores = scores[docs]
+        if len(docs) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+            docs, scores = docs[top], scores[top]
+        return docs, scores
+
+
+class HashingTfidfVectorizer:
+    """HashingVectorizer（文字2-5gram）に IDF を掛けて L2 正規化する特徴抽出
+
+    語彙の辞書を持たないため、学習時のメモリは文書数に比例する分だけで済む。
+    IDF は学習時の文書頻度から TfidfVectorizer と同じ式（smooth_idf）で求めて保持し、
+    学習後に追加する文書もそのまま transform できる（未知の n-gram も特徴になる）。
+    max_df を超える文書に出現する n-gram は TfidfVectorizer と同様に使わない（IDF を 0 にする）。
+    """
+
+    def __init__(self, n_features=2 ** 18, idf=None, max_df=0.95):
+        self.n_features = n_features
+        self.max_df = max_df
+        self.hasher = HashingVectorizer(
+            analyzer='char',
+            ngram_range=(2, 5),
+            n_features=n_features,
+            alternate_sign=False,
+            norm=None,
+            dtype=np.float32
+        )
+        self.idf_ = idf
+
+    def _weight(self, counts):
+        """出現回数の行列（CSR）に IDF を掛けて行ごとに L2 正規化する（data を直接書き換える）"""
+        counts.data *= self.idf_[counts.indices]
+        row_lengths = np.diff(counts.indptr)
+        nonempty = row_lengths > 0
+        norms = np.zeros(counts.shape[0], dtype=np.float32)
+        norms[nonempty] = np.sqrt(np.add.reduceat(counts.data ** 2, counts.indptr[:-1][nonempty]))
+        norms[norms == 0] = 1.0
+        counts.data /= np.repeat(norms, row_lengths)
+        counts.eliminate_zeros()
+        return counts
+
+    def fit_transform(self, corpus):
+        # n-gram の一時文字列を持つのは変換中のチャンクの分だけ
+        chunks = []
+        document_frequency = np.zeros(self.n_features, dtype=np.int64)
+        for start in range(0, len(corpus), TFIDF_HASH_FIT_CHUNK):
+            chunk = self.hasher.transform(corpus[start:start + TFIDF_HASH_FIT_CHUNK]).tocsr()
+            document_frequency += np.bincount(chunk.indices, minlength=self.n_features)
+            chunks.append(chunk)
+        idf = np.log((1 + len(corpus)) / (1 + document_frequency)) + 1.0
+        if len(corpus) > 1:
+            idf[document_frequency > self.max_df * len(corpus)] = 0.0
+        self.idf_ = idf.astype(np.float32)
+        for chunk in chunks:
+            self._weight(chunk)
+        return sp.vstack(chunks, format="csr")
+
+    def transform(self, texts):
+        return self._weight(self.hasher.transform(texts).tocsr())
+
+
+def make_tfidf_vectorizer(num_docs):
+    """TFIDF_FEATURE_EXTRACTOR に従って未学習の特徴抽出器を作る"""
+    if TFIDF_FEATURE_EXTRACTOR == "hashing":
+        return HashingTfidfVectorizer(TFIDF_HASH_FEATURES)
+    return TfidfVectorizer(
+        analyzer='char',
+        ngram_range=(2, 5),
+        max_features=5000,
+        min_df=1,
+        # 文書が1件しかないと max_df で全語が除外されるため緩める
+        max_df=0.95 if num_docs > 1 else 1.0
+    )
+
+
+class TfidfSearchIndex:
+    """学習済みTF-IDFベクトライザと文書行列を保持するインデックス
+
+    訪問記録の保存時は replace_client_documents で該当利用者の文書だけを
+    差し替える。学習済みの語彙・IDFで transform した行を差分行列に追加し、
+    元の行は削除フラグで無効化するため再学習は不要。
+    """
+
+    def __init__(self, records, signature=None, vectorizer=None, doc_matrix=None, keywords=None, shards=None,
+                 bm25=None, bm25_file=None):
+        self.signature = signature
+        self.built_at = time.time()
+        self.version = next(_corpus_version_counter)
+        self._lock = threading.Lock()
+
+        if vectorizer is not None:
+            # 検索アーティファクトから復元（学習済みのベクトライザと文書行列をそのまま使う）
+            self.vectorizer = vectorizer
+            self.doc_matrix = doc_matrix
+        else:
+            corpus = [normalize_text(r["text"]) for r in records]
+            self.vectorizer = make_tfidf_vectorizer(len(corpus))
+            if corpus:
+                self.doc_matrix = self.vectorizer.fit_transform(corpus).tocsr()
+            else:
+                self.doc_matrix = None
+        # BM25 は使う設定のときだけ構築時に作り、それ以外は初めて使うときに作る（またはファイルから読む）
+        self._bm25 = bm25
+        self._bm25_file = bm25_file
+        self._bm25_num_docs = len(records)
+        self._bm25_lock = threading.Lock()
+        self._bm25_delta_cache = None
+
+        self.keywords = keywords if keywords is not None else KeywordIndex(records)
+        self.metadata = MetadataIndex(records)
+        self.set_shards(TFIDF_SCORING_SHARDS if shards is None else shards)
+
+        # システム入力の行（行は追加のみなので、検索側は records の件数で切り出して使う）
+        self._is_db = np.fromiter(
+            (r.get("source") == "システム入力" for r in records), dtype=bool, count=len(records)
+        )
+        self._source_counts = (None, None, None)  # (版, 行数, (システム入力の件数, 事例集の件数))
+        # 検索中に差し替えが起きても整合するよう (records, deleted, delta_matrix) を一括で保持
+        self._state = (list(records), np.zeros(len(records), dtype=bool), None)
+        self._client_rows = {}
+        for i, r in enumerate(records):
+            if r.get("client_id") is not None:
+                self._client_rows.setdefault(r["client_id"], []).append(i)
+        if SEARCH_FIRST_STAGE == "bm25" or SEARCH_MODE == "bm25":
+            self._ensure_bm25()
+
+    @property
+    def records(self):
+        return self._state[0]
+
+    def source_counts(self, num_rows=None):
+        """先頭 num_rows 行（省略時は全行）の (システム入力の件数, 事例集の件数)（版ごとに一度だけ数える）"""
+        num_rows = len(self._state[0]) if num_rows is None else num_rows
+        version, cached_rows, counts = self._source_counts
+        if version != self.version or cached_rows != num_rows:
+            db_count = int(np.count_nonzero(self._is_db[:num_rows]))
+            counts = (db_count, num_rows - db_count)
+            self._source_counts = (self.version, num_rows, counts)
+        return counts
+
+    @property
+    def bm25(self):
+        """学習時の文書の BM25 インデックス（初めて参照されたときにファイルから読むか作る）"""
+        return self._ensure_bm25()
+
+    def _ensure_bm25(self):
+        """BM25 インデックスが無ければファイルから読むか作り、それを返す"""
+        if self._bm25 is None:
+            with self._bm25_lock:
+                if self._bm25 is None and self._bm25_file and os.path.exists(self._bm25_file):
+                    self._bm25 = BM25Index.load(self._bm25_file)
+                if self._bm25 is None:
+                    started = time.time()
+                    records = self._state[0][:self._bm25_num_docs]
+                    self._bm25 = BM25Index.build([normalize_text(r["text"]) for r in records])
+                    print(f"Built BM25 index for {len(records)} records in {time.time() - started:.2f}s")
+        return self._bm25
+
+    @property
+    def delta_size(self):
+        delta_matrix = self._state[2]
+        return 0 if delta_matrix is None else delta_matrix.shape[0]
+
+    def set_shards(self, shards):
+        """文書行列を shards 個の行範囲に分割する（データ配列は共有し、コピーしない）"""
+        num_rows = 0 if self.doc_matrix is None else self.doc_matrix.shape[0]
+        shards = max(1, min(shards, num_rows // TFIDF_SHARD_MIN_ROWS or 1))
+        bounds = np.linspace(0, num_rows, shards + 1).astype(np.int64)
+        self._shards = []
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            if shards == 1:
+                self._shards.append((start, end, self.doc_matrix))
+                continue
+            indptr = self.doc_matrix.indptr
+            lo, hi = indptr[start], indptr[end]
+            shard = sp.csr_matrix(
+                (self.doc_matrix.data[lo:hi], self.doc_matrix.indices[lo:hi], indptr[start:end + 1] - lo),
+                shape=(end - start, self.doc_matrix.shape[1])
+            )
+            self._shards.append((start, end, shard))
+        self.shards = len(self._shards)
+
+    def _map_shards(self, func):
+        """各分割に func(start, end, shard) を適用した結果のリスト（複数ならスレッドで並列実行）"""
+        if len(self._shards) == 1:
+            return [func(*self._shards[0])]
+        pool = get_scoring_pool(len(self._shards))
+        return list(pool.map(lambda args: func(*args), self._shards))
+
+    def _score_base(self, query_dense):
+        """学習時の文書行列とクエリ（密ベクトル）の内積を分割ごとに計算する"""
+        similarities = np.empty(self.doc_matrix.shape[0])
+
+        def score(start, end, shard):
+            # scipy の疎行列積は GIL を解放するため、スレッドで並列に動く
+            similarities[start:end] = shard @ query_dense
+
+        self._map_shards(score)
+        return similarities
+
+    def top_candidates(self, similarities, db_limit=3, other_limit=10, min_similarity=0.01):
+        """表示する類似度（%）の降順に、システム入力上位 db_limit 件・その他上位 other_limit 件の候補を返す
+
+        分割ごとに部分的な上位候補（同点を含む）を求めてから統合するので、全件の並べ替えは不要。
+        同点は行の順に並ぶ。
+        """
+        n = len(similarities)
+        is_db = self._is_db[:n]
+        rounded = np.round(similarities * 100, 1)
+        bounds = [(start, min(end, n)) for start, end, _ in self._shards]
+        if bounds[-1][1] < n:
+            # 学習後に追加された差分行は最後の分割に含める
+            bounds[-1] = (bounds[-1][0], n)
+
+        def shard_top(start, end):
+            candidates = []
+            shard_rounded = rounded[start:end]
+            valid = similarities[start:end] > min_similarity
+            for group, limit in ((is_db[start:end], db_limit), (~is_db[start:end], other_limit)):
+                rows = np.flatnonzero(valid & group)
+                if len(rows) > limit:
+                    threshold = np.partition(shard_rounded[rows], len(rows) - limit)[len(rows) - limit]
+                    rows = rows[shard_rounded[rows] >= threshold]
+                candidates.append(rows + start)
+            return np.sort(np.concatenate(candidates))
+
+        if len(bounds) == 1:
+            candidates = shard_top(*bounds[0])
+        else:
+            pool = get_scoring_pool(len(bounds))
+            candidates = np.concatenate(list(pool.map(lambda b: shard_top(*b), bounds)))
+        return candidates[np.argsort(-rounded[candidates], kind="stable")]
+
+    def _snapshot(self, mask=None):
+        """_state を一度だけ読んで (records, active, delta_matrix) を返す
+
+        active は削除扱いでなく mask に該当する行を示すブール配列。mask は作成後に行が追加されると
+        スナップショットより短いことがあり、追加された行は絞り込み条件を確かめていないので対象外とする。
+        """
+        records, deleted, delta_matrix = self._state
+        active = ~deleted
+        if mask is not None:
+            active[:len(mask)] &= mask[:len(active)]
+            active[len(mask):] = False
+        return records, active, delta_matrix
+
+    def active_rows(self, mask=None):
+        """(records, active) を返す。active は削除扱いでなく mask に該当する行を示すブール配列"""
+        records, active, _ = self._snapshot(mask)
+        return records, active
+
+    def _bm25_delta(self, records):
+        """差分行の BM25 インデックス（学習時の IDF・平均文書長で重み付け、行の追加ごとに作り直す）"""
+        cached = self._bm25_delta_cache
+        if cached is not None and cached[0] == len(records):
+            return cached[1]
+        corpus = [normalize_text(r["text"]) for r in records[self.bm25.num_docs:]]
+        delta = BM25Index.build(corpus, reference=self.bm25)
+        self._bm25_delta_cache = (len(records), delta)
+        return delta
+
+    def bm25_search(self, normalized_input, k=BM25_CANDIDATES, mask=None):
+        """BM25 スコア上位 k 件の (records, 行番号, スコア) を返す（削除扱いの行は除く）"""
+        records, active = self.active_rows(mask)
+        base_size = self.bm25.num_docs
+        docs, scores = self.bm25.search(normalized_input, k, active[:base_size])
+        if len(records) > base_size:
+            delta_docs, delta_scores = self._bm25_delta(records).search(normalized_input, k, active[base_size:])
+            docs = np.concatenate([docs, delta_docs + base_size])
+            scores = np.concatenate([scores, delta_scores])
+            if len(docs) > k:
+                top = np.argpartition(-scores, k - 1)[:k]
+                docs, scores = docs[top], scores[top]
+        return records, docs, scores
+
+    def bm25_candidates(self, normalized_input, k=BM25_CANDIDATES, mask=None):
+        """BM25 の上位 k 件を示すブール配列"""
+        records, docs, _ = self.bm25_search(normalized_input, k, mask)
+        candidates = np.zeros(len(records), dtype=bool)
+        candidates[docs] = True
+        return candidates
+
+    def query(self, normalized_input, mask=None):
+        """クエリと全文書のコサイン類似度を (records, similarities, active) で返す
+
+        active は差し替え済み（削除扱い）でない行を示すブール配列。
+        mask を渡すと該当する行だけを計算し、それ以外の類似度は 0 とする。
+        """
+        records, active, delta_matrix = self._snapshot(mask)
+        if self.doc_matrix is None:
+            return records, np.zeros(len(records)), active
+        # 疎行列 × 密ベクトルの積は疎行列同士の積より速い
+        query_dense = self.vectorizer.transform([normalized_input]).toarray().ravel()
+        # TfidfVectorizer の出力はL2正規化済みなので内積がコサイン類似度になる
+        if mask is None:
+            similarities = self._score_base(query_dense)
+            if delta_matrix is not None:
+                similarities = np.concatenate([similarities, delta_matrix @ query_dense])
+            similarities[~active] = 0.0
+            return records, similarities, active
+
+        # 絞り込み時は対象の行だけを取り出して計算する
+        similarities = np.zeros(len(records))
+        rows = np.flatnonzero(active)
+        base_size = self.doc_matrix.shape[0]
+        base_rows = rows[rows < base_size]
+        if base_rows.size:
+            similarities[base_rows] = self.doc_matrix[base_rows] @ query_dense
+        delta_rows = rows[rows >= base_size]
+        if delta_rows.size:
+            similarities[delta_rows] = delta_matrix[delta_rows - base_size] @ query_dense
+        return records, similarities, active
+
+    def query_batch(self, normalized_inputs, mask=None):
+        """複数クエリの類似度を (records, similarities, active) で返す
+
+        similarities はクエリ数×文書数の配列。クエリをまとめて1つの疎行列に変換し、
+        1回の行列積で全文書との類似度を計算する。
+        """
+        records, active, delta_matrix = self._snapshot(mask)
+        if self.doc_matrix is None:
+            return records, np.zeros((len(normalized_inputs), len(records))), active
+        query_matrix = self.vectorizer.transform(normalized_inputs)
+        similarities = (query_matrix @ self.doc_matrix.T).toarray()
+        if delta_matrix is not None:
+            delta_sims = (query_matrix @ delta_matrix.T).toarray()
+            similarities = np.hstack([similarities, delta_sims])
+        similarities[:, ~active] = 0.0
+        return records, similarities, active
+
+    def client_ids(self):
+        """インデックスに訪問記録がある利用者IDのリスト"""
+        return sorted(self._client_rows)
+
+    def client_rows(self, client_id, num_rows=None):
+        """利用者の訪問記録の行番号のリスト
+
+        num_rows を渡すと、それより後に追加された行（取得済みのスナップショットに無い行）は除く。
+        """
+        rows = self._client_rows.get(client_id, [])
+        if num_rows is not None:
+            rows = [i for i in rows if i < num_rows]
+        return list(rows)
+
+    def client_query_text(self, client_id):
+        """利用者の最新の訪問記録の本文（インデックスに無ければ None）"""
+        records = self._state[0]
+        rows = self._client_rows.get(client_id)
+        if not rows:
+            return None
+        latest = max(rows, key=lambda i: records[i].get("id", 0))
+        return records[latest]["text"]
+
+    def replace_client_documents(self, client_id, new_records):
+        """利用者1人分の文書を差し替える（再学習なし）"""
+        if self.doc_matrix is None:
+            return False
+        vectors = None
+        if new_records:
+            vectors = self.vectorizer.transform([normalize_text(r["text"]) for r in new_records])
+
+        with self._lock:
+            records, deleted, delta_matrix = self._state
+            old_rows = self._client_rows.get(client_id, [])
+
+            deleted = np.concatenate([deleted, np.zeros(len(new_records), dtype=bool)])
+            deleted[old_rows] = True
+            if vectors is not None:
+                delta_matrix = vectors if delta_matrix is None else sp.vstack([delta_matrix, vectors]).tocsr()
+
+            # 行は追加のみなので、先に出現行列を伸ばしておけば検索側は先頭から切り出せる
+            self.keywords.append(new_records)
+            self.metadata.append(new_records)
+            first_row = len(records)
+            self._client_rows[client_id] = list(range(first_row, first_row + len(new_records)))
+            self._is_db = np.concatenate([self._is_db, np.ones(len(new_records), dtype=bool)])
+            self._state = (records + list(new_records), deleted, delta_matrix)
+            self.version = next(_corpus_version_counter)
+        return True
+
+
+def query_visit_record_signature(cur):
+    """visit_record テーブルの状態を表すシグネチャ
+
+    既存行の上書き（UPDATE）は件数・最大IDを変えないため、行の更新日時の最大値も含める。
+    """
+    cur.execute("""
+        SELECT COUNT(*) AS cnt,
+               MAX(visit_record_id) AS max_id,
+               MAX(visit_datetime) AS max_dt,
+               MAX(updated_at) AS max_updated
+        FROM visit_record
+    """)
+    row = cur.fetchone()
+    return (row["cnt"], row["max_id"], str(row["max_dt"]), str(row["max_updated"]))
+
+
+def get_corpus_signature():
+    """cases.json と visit_record テーブルの状態を表すシグネチャを取得"""
+    if os.path.exists(CASE_STUDIES_FILE):
+        stat = os.stat(CASE_STUDIES_FILE)
+        file_sig = (stat.st_mtime_ns, stat.st_size)
+    else:
+        file_sig = None
+
+    try:
+        conn = get_connection()
+        with conn:
+            with conn.cursor() as cur:
+                db_sig = query_visit_record_signature(cur)
+    except Exception as e:
+        print(f"訪問記録シグネチャの取得エラー: {e}")
+        db_sig = None
+
+    return (file_sig, db_sig)
+
+
+def build_tfidf_index():
+    """コーパスを読み込んでTF-IDFインデックスを構築"""
+    signature = get_corpus_signature()
+    records = get_all_records_for_tfidf()
+    started = time.time()
+    if _case_records_failed:
+        # 事例集を読めなかったインデックスは、次回の変更検知で必ず作り直す
+        signature = None
+    index = TfidfSearchIndex(records, signature)
+    print(f"Built TF-IDF index for {len(records)} records in {time.time() - started:.2f}s")
+    return index
+
+
+def _rebuild_tfidf_index():
+    global _tfidf_index
+    try:
+        _tfidf_index = build_tfidf_index()
+    except Exception as e:
+        print(f"TF-IDFインデックスの再構築エラー: {e}")
+
+
+def _refresh_tfidf_index():
+    """変更検知（DBへの問い合わせ）を行い、コーパスが変わっていれば再構築する（バックグラウンド用）"""
+    index = _tfidf_index
+    try:
+        stale = (index.delta_size > TFIDF_DELTA_COMPACT_THRESHOLD
+                 or get_corpus_signature() != index.signature)
+    except Exception as e:
+        print(f"TF-IDFインデックスの変更検知エラー: {e}")
+        return
+    if stale:
+        _rebuild_tfidf_index()
+
+
+def get_tfidf_index():
+    """常駐TF-IDFインデックスを取得（初回は同期構築、変更検知と再構築はバックグラウンド）
+
+    変更検知のDB問い合わせはリクエストの外で行うため、検索がロックやDBの応答を待つことはない。
+    """
+    global _tfidf_index, _tfidf_rebuild_thread, _tfidf_last_check
+
+    if _tfidf_index is None:
+        with _tfidf_index_lock:
+            if _tfidf_index is None:
+                # 事前構築した検索アーティファクトがあれば学習を省略する
+                _tfidf_index = load_search_artifacts() or build_tfidf_index()
+                _tfidf_last_check = time.time()
+        return _tfidf_index
+
+    now = time.time()
+    if now - _tfidf_last_check >= TFIDF_INDEX_CHECK_INTERVAL:
+        with _tfidf_index_lock:
+            if now - _tfidf_last_check >= TFIDF_INDEX_CHECK_INTERVAL:
+                _tfidf_last_check = now
+                refreshing = _tfidf_rebuild_thread is not None and _tfidf_rebuild_thread.is_alive()
+                if not refreshing:
+                    _tfidf_rebuild_thread = threading.Thread(target=_refresh_tfidf_index, daemon=True)
+                    _tfidf_rebuild_thread.start()
+
+    # 再構築中は構築済みのインデックスで検索を続ける
+    return _tfidf_index
+
+
+def on_visit_record_saved(client_id, db_signature_before=None, db_signature_after=None):
+    """訪問記録保存時のフック：該当利用者の文書だけを常駐インデックスに反映
+
+    db_signature_before / db_signature_after は保存したトランザクション内で読んだ
+    visit_record のシグネチャ（他のワーカーが同時に行った変更は含まない）。
+    インデックスが保存直前の状態に追随していた場合だけシグネチャを進め、不要な再構築を避ける。
+    それ以外（他のワーカーの変更が未反映）はシグネチャを据え置き、変更検知で再構築させる。
+    """
+    records = get_visit_records_for_tfidf(client_id)
+
+    index = _tfidf_index
+    if index is not None and index.replace_client_documents(client_id, records):
+        file_sig, db_sig = index.signature or (None, None)
+        if db_signature_after is not None and db_sig == db_signature_before:
+            index.signature = (file_sig, db_signature_after)
+
+    upsert_db_record_embeddings(records)
+
+
+# ---- 検索アーティファクト ----
+# build_search_index.py でデプロイ前に検索用のデータを一括で構築し、
+# SEARCH_ARTIFACTS_DIR/<版>/ に書き出す（CURRENT に現在の版名を書く）。
+# アプリは起動時にこれを読み取り専用でロードし、TF-IDFの学習と埋め込み計算を省略する。
+# 訪問記録の本文を含むため、ディレクトリの取り扱いはDBと同様に注意すること。
+
+SEARCH_ARTIFACTS_DIR = os.environ.get(
+    "SEARCH_ARTIFACTS_DIR", os.path.join(os.path.dirname(__file__), "data", "search_index")
+)
+SEARCH_ARTIFACTS_FORMAT = 1
+SEARCH_ARTIFACT_FILES = {
+    "records": "records.jsonl",          # 検索用レコード（行の並びは文書行列と同じ）
+    "vectorizer": "vectorizer.json",     # TF-IDFの設定・語彙・IDF
+    "doc_matrix": "doc_matrix.npz",      # 文書行列（CSR）
+    "keywords": "keywords.npz",          # 事例 × キーワードの出現行列
+    "keyword_vocabulary": "keyword_vocabulary.json",
+    "embeddings": "embeddings.npy",      # 正規化済みの合成データ埋め込み（float32）
+    "ids": "ids.json",                   # レコードID・埋め込み行の対応
+    "bm25": "bm25.npz",                  # 文字バイグラムの転置インデックス（圧縮）
+}
+TFIDF_ARTIFACT_PARAMS = ["analyzer", "ngram_range", "max_features", "min_df", "max_df", "lowercase", "norm",
+                         "use_idf", "smooth_idf", "sublinear_tf"]
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def write_search_artifacts(base_dir=None, with_embeddings=True):
+    """検索アーティファクトを構築して新しい版のディレクトリに書き出し、その版名を返す"""
+    base_dir = base_dir or SEARCH_ARTIFACTS_DIR
+    started = time.time()
+    signature = get_corpus_signature()
+    records = get_all_records_for_tfidf()
+    if _case_records_failed:
+        raise RuntimeError("事例集ストアを読み込めなかったため、検索アーティファクトを書き出しません")
+    index = TfidfSearchIndex(records, signature)
+
+    # 同じ秒に複数回（別プロセスを含む）書き出しても版名・一時ディレクトリが衝突しないようにする
+    version = f"{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}-{os.getpid()}"
+    target = os.path.join(base_dir, version)
+    os.makedirs(base_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=base_dir, prefix=f".{version}.", suffix=".tmp")
+    try:
+        os.chmod(tmp_dir, 0o755)  # mkdtemp は 0700 で作るため、アプリの実行ユーザーからも読めるようにする
+
+        def path(name):
+            return os.path.join(tmp_dir, SEARCH_ARTIFACT_FILES[name])
+
+        with open(path("records"), "w", encoding="utf-8") as f:
+            for r in records:
+                f.write(json.dumps(r, ensure_ascii=False, default=str) + "\n")
+
+        with open(path("vectorizer"), "w", encoding="utf-8") as f:
+            if isinstance(index.vectorizer, HashingTfidfVectorizer):
+                json.dump({
+                    "kind": "hashing",
+                    "n_features": index.vectorizer.n_features,
+                    "idf": index.vectorizer.idf_.tolist()
+                }, f)
+            else:
+                params = index.vectorizer.get_params()
+                json.dump({
+                    "kind": "tfidf",
+                    "params": {key: params[key] for key in TFIDF_ARTIFACT_PARAMS},
+                    "vocabulary": {term: int(j) for term, j in index.vectorizer.vocabulary_.items()},
+                    "idf": index.vectorizer.idf_.tolist()
+                }, f, ensure_ascii=False)
+        sp.save_npz(path("doc_matrix"), index.doc_matrix)
+        sp.save_npz(path("keywords"), index.keywords.matrix)
+        index.bm25.save(path("bm25"))
+        with open(path("keyword_vocabulary"), "w", encoding="utf-8") as f:
+            json.dump(sorted(index.keywords.vocabulary, key=index.keywords.vocabulary.get), f, ensure_ascii=False)
+
+        embedding_ids = []
+        if with_embeddings:
+            embeddings, ids = load_synthetic_embeddings()
+            if embeddings is None and compute_and_cache_synthetic_embeddings():
+                embeddings, ids = load_synthetic_embeddings()
+            if embeddings is not None:
+                np.save(path("embeddings"), np.asarray(embeddings, dtype=np.float32))
+                embedding_ids = list(ids)
+            else:
+                print("埋め込みモデルが使えないため、埋め込みは含めません")
+        with open(path("ids"), "w", encoding="utf-8") as f:
+            json.dump({
+                "records": [r.get("id") for r in records],
+                "embeddings": embedding_ids
+            }, f, ensure_ascii=False, default=str)
+
+        file_sig, db_sig = signature
+        manifest = {
+            "format": SEARCH_ARTIFACTS_FORMAT,
+            "version": version,
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "embedding_model": get_embedding_model_id() if embedding_ids else None,
+            "num_records": len(records),
+            "source": {
+                "cases_sha256": file_sha256(CASE_STUDIES_FILE) if file_sig else None,
+                "visit_records": list(db_sig) if db_sig else None
+            },
+            "files": {
+                name: file_sha256(path(name))
+                for name in SEARCH_ARTIFACT_FILES if os.path.exists(path(name))
+            }
+        }
+        with open(os.path.join(tmp_dir, "manifest.json"), "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+        os.replace(tmp_dir, target)
+    finally:
+        # 途中で失敗した場合は書きかけの一時ディレクトリを残さない
+        if os.path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    current_fd, current_tmp = tempfile.mkstemp(dir=base_dir, prefix=".CURRENT.", suffix=".tmp")
+    try:
+        with open(current_fd, "w", encoding="utf-8") as f:
+            f.write(version)
+        os.chmod(current_tmp, 0o644)
+        os.replace(current_tmp, os.path.join(base_dir, "CURRENT"))
+    except BaseException:
+        if os.path.exists(current_tmp):
+            os.remove(current_tmp)
+        raise
+    print(f"Wrote search artifacts {version} ({len(records)} records) in {time.time() - started:.2f}s")
+    return version
+
+
+def load_search_artifacts(base_dir=None):
+    """現在の版の検索アーティファクトから TfidfSearchIndex を復元（無い・古い・壊れている場合は None）
+
+    事例集（cases.json）の内容ハッシュが構築時と異なる場合は使わない。
+    訪問記録が構築後に増えている場合は、ロード後の変更検知でバックグラウンド再構築される。
+    """
+    global _synthetic_embeddings, _synthetic_ids
+    base_dir = base_dir or SEARCH_ARTIFACTS_DIR
+    current_file = os.path.join(base_dir, "CURRENT")
+    if not os.path.exists(current_file):
+        return None
+
+    try:
+        started = time.time()
+        with open(current_file, "r", encoding="utf-8") as f:
+            artifact_dir = os.path.join(base_dir, f.read().strip())
+        with open(os.path.join(artifact_dir, "manifest.json"), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest.get("format") != SEARCH_ARTIFACTS_FORMAT:
+            print("検索アーティファクトの形式が古いため使用しません")
+            return None
+
+        def path(name):
+            return os.path.join(artifact_dir, SEARCH_ARTIFACT_FILES[name])
+
+        for name, digest in manifest["files"].items():
+            if file_sha256(path(name)) != digest:
+                print(f"検索アーティファクトのハッシュが一致しません: {name}")
+                return None
+        cases_sha256 = manifest["source"]["cases_sha256"]
+        if os.path.exists(CASE_STUDIES_FILE) and cases_sha256 != file_sha256(CASE_STUDIES_FILE):
+            print("事例集が検索アーティファクトの構築後に変更されているため使用しません")
+            return None
+
+        with open(path("records"), "r", encoding="utf-8") as f:
+            records = [json.loads(line) for line in f]
+        with open(path("vectorizer"), "r", encoding="utf-8") as f:
+            vectorizer_data = json.load(f)
+        if vectorizer_data.get("kind") == "hashing":
+            vectorizer = HashingTfidfVectorizer(
+                vectorizer_data["n_features"], np.asarray(vectorizer_data["idf"], dtype=np.float32)
+            )
+        else:
+            params = dict(vectorizer_data["params"], ngram_range=tuple(vectorizer_data["params"]["ngram_range"]))
+            vectorizer = TfidfVectorizer(**params)
+            vectorizer.vocabulary_ = vectorizer_data["vocabulary"]
+            vectorizer.idf_ = np.asarray(vectorizer_data["idf"])
+        doc_matrix = sp.load_npz(path("doc_matrix")).tocsr()
+        with open(path("keyword_vocabulary"), "r", encoding="utf-8") as f:
+            keyword_vocabulary = {keyword: j for j, keyword in enumerate(json.load(f))}
+        keywords = KeywordIndex(records, keyword_vocabulary, sp.load_npz(path("keywords")))
+
+        # 構築時の訪問記録のシグネチャを引き継ぎ、以降の変更だけを検知する
+        file_sig, _ = get_corpus_signature()
+        db_sig = manifest["source"]["visit_records"]
+        signature = (file_sig, tuple(db_sig) if db_sig else None)
+        bm25_file = path("bm25") if "bm25" in manifest["files"] else None
+        index = TfidfSearchIndex(
+            records, signature, vectorizer=vectorizer, doc_matrix=doc_matrix, keywords=keywords, bm25_file=bm25_file
+        )
+
+        if "embeddings" in manifest["files"]:
+            if manifest["embedding_model"] == get_embedding_model_id():
+                with open(path("ids"), "r", encoding="utf-8") as f:
+                    _synthetic_ids = json.load(f)["embeddings"]
+                _synthetic_embeddings = np.load(path("embeddings"), mmap_mode="r")
+            else:
+                print(f"検索アーティファクトの埋め込みは {manifest['embedding_model']} で計算されているため使用しません")
+
+        # 表示用テキストは事例集の表示用ストアから読む
+        with _case_records_lock:
+            ensure_case_store()
+        print(f"Loaded search artifacts {manifest['version']} ({len(records)} records) in {time.time() - started:.2f}s")
+        return index
+    except Exception as e:
+        print(f"検索アーティファクトの読み込みエラー: {e}")
+        return None
+
+
+# ---- 類似検索結果キャッシュ ----
+# 正規化済み入力テキストをキーに、最終的なランキング結果とキーワードを保持する（LRU + TTL）。
+# コーパスの版が変わったエントリはヒットさせない。
+
+SEARCH_CACHE_MAX_SIZE = 256
+SEARCH_CACHE_TTL = 600  # 秒
+
+
+class SearchResultCache:
+    """LRU + TTL の検索結果キャッシュ（キーは正規化済み入力テキストと絞り込み条件）"""
+
+    def __init__(self, max_size=256, ttl=600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # キー -> (保存時刻, 値)
+        self._lock = threading.Lock()
+        self._version = None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version):
+        with self._lock:
+            if version != self._version:
+                # コーパスが更新されたら全エントリを破棄
+                self._entries.clear()
+                self._version = version
+            entry = self._entries.get(key)
+            if entry is None or time.time() - entry[0] > self.ttl:
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, version, value):
+        with self._lock:
+            if version != self._version:
+                return
+            self._entries[key] = (time.time(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def get_stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "corpus_version": self._version
+            }
+
+
+_search_cache = SearchResultCache(SEARCH_CACHE_MAX_SIZE, SEARCH_CACHE_TTL)
+
+
+def parse_list_param(value, name="required_keywords"):
+    """リスト（JSON配列）またはカンマ・空白区切りの文字列を値のリストにする
+
+    それ以外の型（数値・オブジェクトなど）や、要素が文字列・数値でない場合は ValueError。
+    """
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = re.split(r"[,、\s]+", value)
+    if not isinstance(value, list):
+        raise ValueError(f"{name} は配列または文字列で指定してください")
+    if any(isinstance(v, bool) or not isinstance(v, (str, int, float)) for v in value):
+        raise ValueError(f"{name} の要素は文字列で指定してください")
+    return [str(v).strip() for v in value if str(v).strip()]
+
+
+def build_search_mask(index, required_keywords=None, filters=None):
+    """検索対象を絞り込むブール配列（条件なしは None）
+
+    required_keywords: すべて含む事例に限定するキーワード（AND 条件）
+    filters: 事例メタデータの条件（MetadataIndex.filter_rows を参照）
+    """
+    num_rows = len(index.records)
+    mask = None
+    if required_keywords:
+        mask = index.keywords.filter_rows(required_keywords, num_rows)
+    if filters:
+        metadata_mask = index.metadata.filter_rows(filters, num_rows)
+        mask = metadata_mask if mask is None else mask & metadata_mask
+    return mask
+
+
+# 類似事例検索の入力項目（この順に連結して検索する）
+SEARCH_INPUT_FIELDS = [
+    "know", "ninchi_kinou", "symptom", "body_con", "life_con", "honnin_will", "kangosha_will"
+]
+
+
+# 類似事例検索の方式（リクエストの mode で指定、省略時は SEARCH_MODE）
+#   tfidf: TF-IDF（文字n-gram）のコサイン類似度
+#   embedding: 埋め込みのセマンティック類似度のみ
+#   hybrid: セマンティック + TF-IDF + キーワード重複
+#   bm25: 文字バイグラムの転置インデックス（BM25）
+SEARCH_MODES = ("tfidf", "embedding", "hybrid", "bm25")
+SEARCH_MODE = os.environ.get("SEARCH_MODE", "tfidf")
+SEARCH_MODE_WEIGHTS = {
+    "embedding": (1.0, 0.0, 0.0),
+    "hybrid": (ALPHA_EMBEDDING, ALPHA_TFIDF, ALPHA_KEYWORD)
+}
+
+
+def run_search_mode(mode, normalized_input, index, keywords, mask, timer):
+    """mode の検索を常駐インデックスで実行する"""
+    records = index.records
+    if mode == "bm25":
+        return search_similar_bm25(normalized_input, records, keywords, index=index, mask=mask, timer=timer)
+    if mode in SEARCH_MODE_WEIGHTS:
+        return search_similar_embeddings(
+            normalized_input, records, keywords, index=index, mask=mask,
+            weights=SEARCH_MODE_WEIGHTS[mode], timer=timer
+        )
+    return search_similar_tfidf(normalized_input, records, keywords, index=index, mask=mask, timer=timer)
+
+
 @app.route("/api/search_similar", methods=["POST"])
 def search_similar():
-    """TF-IDF類似事例検索API（文字n-gramベースで正確な類似度を計算）"""
+    """類似事例検索API
+
+    mode（tfidf / embedding / hybrid / bm25、省略時は SEARCH_MODE）で検索方式を選ぶ。
+    埋め込みが使えない場合（モデル未導入・合成データの埋め込みを計算中）は TF-IDF で検索する。
+    stats.timings_ms に段階（StageTimer）ごとの所要時間を返す。serialise は本文の大半を占める results の変換時間で、
+    残り（keywords・stats）の変換を含めた値は Server-Timing ヘッダで返す。
+    キャッシュから返す場合は、その応答自身の所要時間（cache と serialise）を返す。
+    """
     data = request.json or {}
     
-    input_parts = [
-        data.get("know", ""),
-        data.get("ninchi_kinou", ""),
-        data.get("symptom", ""),
-        data.get("body_con", ""),
-        data.get("life_con", ""),
-        data.get("honnin_will", ""),
-        data.get("kangosha_will", "")
-    ]
-    input_text = " ".join(input_parts)
+    input_text = " ".join(data.get(field, "") for field in SEARCH_INPUT_FIELDS)
     
     if not input_text.strip():
         return jsonify({"results": [], "keywords": []})
     
     # 入力テキストを正規化（書き方の差異を吸収）
     normalized_input = normalize_text(input_text)
-    keywords = extract_keywords(normalized_input, top_n=8)
     
-    # システム入力データとPDF事例集を統合して取得
-    records = get_all_records_for_tfidf()
+    # システム入力データとPDF事例集を統合した常駐インデックスを取得
+    index = get_tfidf_index()
+    
+    # キーワードによる絞り込み（例: ["独居", "服薬管理困難"] をすべて含む事例）
+    try:
+        required_keywords = parse_list_param(data.get("required_keywords"))
+    except ValueError as e:
+        return jsonify({"results": [], "keywords": [], "error": str(e)}), 400
+    # メタデータによる絞り込み（例: {"living_situation": "独居", "dementia_adl": "IIb-IIIa"}）
+    filters = data.get("filters") or {}
+    if not isinstance(filters, dict):
+        return jsonify({"results": [], "keywords": [], "error": "filters はオブジェクトで指定してください"}), 400
+    mode = data.get("mode") or SEARCH_MODE
+    if mode not in SEARCH_MODES:
+        return jsonify({
+            "results": [], "keywords": [], "error": f"mode は {', '.join(SEARCH_MODES)} のいずれかを指定してください"
+        }), 400
+    cache_key = (
+        mode, normalized_input, tuple(sorted(required_keywords)), json.dumps(filters, sort_keys=True, ensure_ascii=False)
+    )
+    
+    # 同じ入力・同じコーパスなら検索とスコアリングを省略
+    cache_timer = StageTimer()
+    cached = _search_cache.get(cache_key, index.version)
+    cache_timer.lap("cache")
+    if cached is not None:
+        # 保存されている所要時間は検索したときのものなので、この応答の所要時間に差し替える
+        results_json = app.json.dumps(cached["results"])
+        cache_timer.lap("serialise")
+        stats = dict(cached["stats"], cache="hit", timings_ms=cache_timer.summary())
+        return timed_json_response(dict(cached, stats=stats), cache_timer, results_json)
+    
+    keywords = extract_keywords(normalized_input, top_n=8)
+    records = index.records
     
     if not records:
         return jsonify({
@@ -731,11 +3329,26 @@ def search_similar():
             "message": "事例データがありません。訪問記録を登録するか、PDF事例集をインポートしてください。"
         })
     
-    search_method = "tfidf"
+    search_method = mode
+    fallback_reason = None
+    timer = StageTimer()
+    
+    try:
+        mask = build_search_mask(index, required_keywords, filters)
+    except (ValueError, TypeError) as e:
+        return jsonify({"results": [], "keywords": keywords, "error": str(e)}), 400
+    timer.lap("retrieve")
     
     try:
-        # TF-IDFのみを使用（より正確な類似度計算のため）
-        results = search_similar_tfidf(normalized_input, records, keywords)
+        try:
+            results = run_search_mode(mode, normalized_input, index, keywords, mask, timer)
+        except Exception as e:
+            if mode not in SEARCH_MODE_WEIGHTS:
+                raise
+            print(f"{mode} 検索ができないため TF-IDF で検索します: {e}")
+            search_method = "tfidf"
+            fallback_reason = str(e)
+            results = run_search_mode("tfidf", normalized_input, index, keywords, mask, timer)
         
     except Exception as e:
         return jsonify({
@@ -744,22 +3357,299 @@ def search_similar():
             "error": str(e)
         })
     
-    # 統計情報を追加
-    db_count = len([r for r in records if r.get("source") == "システム入力"])
-    pdf_count = len([r for r in records if r.get("source") != "システム入力"])
+    # 統計情報を追加（件数はインデックスの版ごとに数えたものを使う）
+    db_count, pdf_count = index.source_counts(len(records))
+    timer.lap("format")
+    # 本文の大半を占める results はここで JSON にし、その時間を timings_ms の serialise に含める
+    results_json = app.json.dumps(results)
+    timer.lap("serialise")
     
-    return jsonify({
+    payload = {
         "results": results,
         "keywords": keywords,
         "stats": {
             "total_records": len(records),
             "db_records": db_count,
             "pdf_records": pdf_count,
-            "search_method": search_method
+            "search_method": search_method,
+            "timings_ms": timer.summary()
         }
+    }
+    if fallback_reason is not None:
+        # 埋め込みが使えるようになったら本来の方式で検索し直すため、キャッシュしない
+        payload["stats"].update(requested_mode=mode, fallback_reason=fallback_reason)
+        return timed_json_response(dict(payload, stats=dict(payload["stats"], cache="miss")), timer, results_json)
+    _search_cache.put(cache_key, index.version, payload)
+    
+    return timed_json_response(dict(payload, stats=dict(payload["stats"], cache="miss")), timer, results_json)
+
+
+def timed_json_response(payload, timer, results_json=None):
+    """payload を JSON のレスポンスにし、その時間を serialise として測る
+
+    results_json（app.json.dumps で変換済みの payload["results"]）を渡すと、results は変換し直さずに本文へ差し込む。
+    段階ごとの所要時間（serialise と合計を含む）は Server-Timing ヘッダで返す。
+    """
+    if results_json is None:
+        response = jsonify(payload)
+    else:
+        rest = app.json.dumps({key: value for key, value in payload.items() if key != "results"})
+        response = app.response_class(f'{{"results":{results_json},{rest[1:]}\n', mimetype=app.json.mimetype)
+    timer.lap("serialise")
+    response.headers["Server-Timing"] = ", ".join(f"{stage};dur={ms}" for stage, ms in timer.summary().items())
+    return response
+
+
+SEARCH_BATCH_CHUNK_SIZE = 256  # 1回の行列積・モデル呼び出しで扱うクエリ数（上限）
+SEARCH_BATCH_MAX_SIMILARITY_BYTES = 64 * 1024 * 1024  # 1チャンクの類似度行列（クエリ数×文書数）の上限
+
+
+def batch_chunk_size(num_rows, num_matrices=1):
+    """類似度行列（hybrid は TF-IDF とセマンティックの2つ）が SEARCH_BATCH_MAX_SIMILARITY_BYTES に収まるチャンクのクエリ数"""
+    per_query = max(num_rows, 1) * np.dtype(np.float64).itemsize * num_matrices
+    return max(1, min(SEARCH_BATCH_CHUNK_SIZE, SEARCH_BATCH_MAX_SIMILARITY_BYTES // per_query))
+
+
+def _batch_client_id(value, name):
+    """バッチ検索の利用者ID（整数、または数字だけの文字列）を int にする"""
+    if isinstance(value, bool) or not isinstance(value, (int, str)) or not str(value).strip().isdigit():
+        raise TypeError(f"{name} は整数で指定してください")
+    return int(value)
+
+
+def resolve_batch_queries(index, data):
+    """バッチ検索の入力を (識別子, 利用者ID, 正規化済みテキスト) のリストにする
+
+    queries: 文字列、または {"text": ...} / search_similar と同じ項目 / {"client_id": ...} の辞書
+    client_ids: 利用者IDのリスト（各利用者の最新の訪問記録で検索する）
+    """
+    queries = data.get("queries") or []
+    client_ids = data.get("client_ids") or []
+    if not isinstance(queries, list) or not isinstance(client_ids, list):
+        raise TypeError("queries・client_ids は配列で指定してください")
+    items = []
+    for i, q in enumerate(queries):
+        if isinstance(q, str):
+            q = {"text": q}
+        if not isinstance(q, dict):
+            raise TypeError(f"queries[{i}] は文字列またはオブジェクトで指定してください")
+        if q.get("client_id") is not None:
+            cid = _batch_client_id(q["client_id"], f"queries[{i}].client_id")
+            items.append((q.get("id", i), cid, index.client_query_text(cid)))
+            continue
+        for field in ("text",) + tuple(SEARCH_INPUT_FIELDS):
+            if q.get(field) is not None and not isinstance(q[field], str):
+                raise TypeError(f"queries[{i}].{field} は文字列で指定してください")
+        text = q.get("text") or " ".join(q.get(field, "") or "" for field in SEARCH_INPUT_FIELDS)
+        items.append((q.get("id", i), None, text))
+    for i, cid in enumerate(client_ids):
+        cid = _batch_client_id(cid, f"client_ids[{i}]")
+        items.append((cid, cid, index.client_query_text(cid)))
+    return [
+        (query_id, cid, normalize_text(text) if text and text.strip() else None)
+        for query_id, cid, text in items
+    ]
+
+
+def iter_batch_search(index, queries, method="tfidf", required_keywords=None, filters=None):
+    """バッチ類似事例検索の結果を1クエリずつ返すジェネレータ
+
+    batch_chunk_size 件ごとに、TF-IDFはまとめて1回の行列積で計算し、
+    hybrid の場合はクエリの埋め込みも1回のモデル呼び出しで計算する。
+    利用者IDで検索した場合はその利用者自身の訪問記録を結果から除く。
+    """
+    base_mask = build_search_mask(index, required_keywords, filters)
+    model = get_embedding_model() if method == "hybrid" else None
+    if method == "hybrid" and model is None:
+        raise Exception("Embedding model not available")
+
+    chunk_size = batch_chunk_size(len(index.records), 2 if method == "hybrid" else 1)
+    for start in range(0, len(queries), chunk_size):
+        chunk = queries[start:start + chunk_size]
+        texts = [text for _, _, text in chunk if text]
+
+        if texts:
+            records, similarities, active = index.query_batch(texts, mask=base_mask)
+        if method == "hybrid" and texts:
+            # セマンティック類似度もチャンク分を行列積でまとめて計算する（失敗は各クエリのエラーにする）
+            embedding_error = None
+            try:
+                query_embeddings = encode_queries(texts)
+                embedding_sims, embedding_scored = batch_embedding_similarities(
+                    index, records, active, query_embeddings,
+                    exact=base_mask is not None or SEARCH_FIRST_STAGE == "bm25"
+                )
+            except Exception as e:
+                embedding_error = e
+
+        row = 0
+        for query_id, cid, text in chunk:
+            item = {"id": query_id}
+            if cid is not None:
+                item["client_id"] = cid
+            if not text:
+                item.update({"results": [], "keywords": [], "error": "検索に使う入力がありません"})
+                yield item
+                continue
+
+            keywords = extract_keywords(text, top_n=8)
+            # 行列積の後に追加された行は類似度を持たないので除く
+            own_rows = index.client_rows(cid, len(records)) if cid is not None else []
+            try:
+                sims = similarities[row]
+                sims[own_rows] = 0.0
+                if method == "hybrid":
+                    if embedding_error is not None:
+                        raise embedding_error
+                    query_active = active
+                    if own_rows:
+                        query_active = active.copy()
+                        query_active[own_rows] = False
+                    results = search_similar_embeddings(
+                        text, records, keywords, index=index, mask=base_mask,
+                        query_embedding=query_embeddings[row], tfidf_result=(records, sims, query_active),
+                        embedding_result=(embedding_sims[row], embedding_scored[row])
+                    )
+                else:
+                    results = build_tfidf_results(index, records, sims)
+                item.update({"results": results, "keywords": keywords})
+            except Exception as e:
+                item.update({"results": [], "keywords": keywords, "error": str(e)})
+            row += 1
+            yield item
+
+
+@app.route("/api/search_similar_batch", methods=["POST"])
+def search_similar_batch():
+    """複数の入力・利用者をまとめて類似事例検索するAPI（NDJSONで1行ずつ返す）
+
+    例: {"client_ids": [1, 2, 3]} / {"queries": [{"know": "..."}, "一人暮らしで..."]}
+    """
+    data = request.json or {}
+    method = data.get("method", "tfidf")
+    if method not in ("tfidf", "hybrid"):
+        return jsonify({"status": "error", "message": "method は tfidf または hybrid を指定してください"}), 400
+    filters = data.get("filters") or {}
+    if not isinstance(filters, dict):
+        return jsonify({"status": "error", "message": "filters はオブジェクトで指定してください"}), 400
+    try:
+        required_keywords = parse_list_param(data.get("required_keywords"))
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    index = get_tfidf_index()
+    try:
+        queries = resolve_batch_queries(index, data)
+        build_search_mask(index, required_keywords, filters)
+    except (ValueError, TypeError) as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    # ストリームを始めた後（200 の後）に失敗しないよう、埋め込みモデルはここで確認する
+    if method == "hybrid" and get_embedding_model() is None:
+        return jsonify({"status": "error", "message": "埋め込みモデルが利用できないため hybrid は使えません"}), 503
+
+    def generate():
+        for item in iter_batch_search(index, queries, method, required_keywords, filters):
+            yield json.dumps(item, ensure_ascii=False) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+
+@app.route("/api/search_cache_stats")
+def search_cache_stats():
+    """類似検索結果キャッシュのヒット・ミス数"""
+    return jsonify({"status": "ok", "cache": _search_cache.get_stats()})
+
+
+@app.route("/api/embedding_worker_stats")
+def embedding_worker_stats():
+    """推論スレッドのバッチ処理とクエリ埋め込みキャッシュの統計"""
+    worker = _embedding_worker
+    return jsonify({
+        "status": "ok",
+        "worker": worker.get_stats() if worker is not None else None,
+        "query_cache": _query_embedding_cache.get_stats()
     })
 
 
+# ---- 起動時のウォームアップ ----
+# 埋め込みモデル・合成データの埋め込み・TF-IDFインデックスを起動時にまとめてロードし、
+# 最初の検索リクエストで数分待たされないようにする。
+# SEARCH_PRELOAD=1 で起動時（gunicorn では post_fork）に実行し、/readyz は完了まで 503 を返す。
+
+SEARCH_PRELOAD = os.environ.get("SEARCH_PRELOAD", "0") == "1"
+
+_warmup_lock = threading.Lock()
+_warmup_thread = None
+_warmup_state = {"status": "not_started", "steps": {}, "error": None}
+
+
+def warm_up_search():
+    """検索に必要なモデル・埋め込み・インデックスをロードし、ダミー検索を1回実行する"""
+    _warmup_state.update(status="loading", steps={}, error=None)
+    started = time.time()
+
+    def step(name, func):
+        step_started = time.time()
+        result = func()
+        _warmup_state["steps"][name] = round(time.time() - step_started, 3)
+        return result
+
+    try:
+        index = step("tfidf_index", get_tfidf_index)
+        model = step("embedding_model", get_embedding_model)
+        if model is not None:
+            def load_embeddings():
+                embeddings, _ = load_synthetic_embeddings()
+                if embeddings is None and compute_and_cache_synthetic_embeddings():
+                    embeddings, _ = load_synthetic_embeddings()
+                if embeddings is not None:
+                    get_ann_index(embeddings, build=True)
+            step("synthetic_embeddings", load_embeddings)
+            db_records = [r for r in index.records if r.get("source") == "システム入力"]
+            if db_records:
+                step("db_record_embeddings", lambda: get_db_record_embeddings(model, db_records))
+            step("query_encode", lambda: encode_texts(["query: ウォームアップ"]))
+        step("tfidf_query", lambda: index.query(normalize_text("ウォームアップ")))
+        _warmup_state["status"] = "ready"
+        print(f"Search warm-up finished in {time.time() - started:.2f}s")
+    except Exception as e:
+        _warmup_state.update(status="failed", error=str(e))
+        print(f"検索のウォームアップエラー: {e}")
+
+
+def start_warmup():
+    """ウォームアップをバックグラウンドで開始（実行中・完了済みなら何もしない）"""
+    global _warmup_thread
+    with _warmup_lock:
+        # fork 後の子プロセスには親のスレッドが引き継がれないのでやり直す
+        running = _warmup_thread is not None and _warmup_thread.is_alive()
+        if _warmup_state["status"] == "ready" or running:
+            return _warmup_thread
+        _warmup_state["status"] = "loading"
+        _warmup_thread = threading.Thread(target=warm_up_search, daemon=True)
+        _warmup_thread.start()
+        return _warmup_thread
+
+
+@app.route("/healthz")
+def healthz():
+    """プロセスが応答できるか（ロード状況に関係なく 200）"""
+    return jsonify({"status": "ok"})
+
+
+@app.route("/readyz")
+def readyz():
+    """検索の準備ができているか（プリロード有効時は完了まで 503）"""
+    ready = not SEARCH_PRELOAD or _warmup_state["status"] == "ready"
+    body = {
+        "status": "ready" if ready else _warmup_state["status"],
+        "preload": SEARCH_PRELOAD,
+        "steps": _warmup_state["steps"],
+        "error": _warmup_state["error"]
+    }
+    return jsonify(body), 200 if ready else 503
+
+
 # ================================
 #  3. アセスメントシート DB API
 # ================================
@@ -1020,6 +3910,10 @@ def save_visit_record():
     with conn:
         with conn.cursor() as cur:
 
+            # 保存前後のシグネチャを同じトランザクション（同じスナップショット）で読み、
+            # 他のワーカーの同時の変更を含まない「この保存による変化」だけを常駐インデックスに伝える
+            signature_before = query_visit_record_signature(cur)
+
             cur.execute("SELECT visit_record_id FROM visit_record WHERE client_id=%s", (cid,))
             row = cur.fetchone()
 
@@ -1104,8 +3998,22 @@ def save_visit_record():
                     vr_other
                 ))
 
+            # 対象者一覧で集計しなくて済むよう最終訪問日を更新
+            cur.execute("""
+                UPDATE client
+                   SET last_visit_date = (SELECT MAX(visit_datetime) FROM visit_record WHERE client_id=%s)
+                 WHERE client_id=%s
+            """, (cid, cid))
+
+            signature_after = query_visit_record_signature(cur)
+
         conn.commit()
 
+    try:
+        on_visit_record_saved(int(cid), signature_before, signature_after)
+    except Exception as e:
+        print(f"類似検索インデックスの更新エラー: {e}")
+
     return jsonify({"status": "saved"})
 
 
@@ -1347,96 +4255,149 @@ def save_dbd13():
 
 # ------- 対象者一覧取得API -------
 
+CLIENT_LIST_DEFAULT_LIMIT = 50
+CLIENT_LIST_MAX_LIMIT = 500
+
+
+def escape_like(value):
+    """LIKE 検索用に % と _ をエスケープ"""
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
 @app.route("/api/get_clients")
 def get_clients():
-    """対象者一覧を取得"""
+    """対象者一覧を取得
+
+    client_id の降順でキーセットページングする。
+    ?after_id=<前ページ最後のID>&limit=<件数> に加えて、
+    name / disease / living で氏名・疾患名・生活環境の部分一致フィルタを指定できる。
+    """
+    after_id = to_int_or_none(request.args.get("after_id"))
+    limit = to_int_or_none(request.args.get("limit")) or CLIENT_LIST_DEFAULT_LIMIT
+    limit = max(1, min(limit, CLIENT_LIST_MAX_LIMIT))
+
+    conditions = []
+    params = []
+    if after_id is not None:
+        conditions.append("c.client_id < %s")
+        params.append(after_id)
+    for arg, column in (("name", "c.client_name"),
+                        ("disease", "c.disease_name"),
+                        ("living", "c.living_environment")):
+        value = (request.args.get(arg) or "").strip()
+        if value:
+            conditions.append(f"{column} LIKE %s")
+            params.append(f"%{escape_like(value)}%")
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
     conn = get_connection()
     with conn:
         with conn.cursor() as cur:
-            cur.execute("""
+            # 次ページの有無を判定するため1件多く取得する
+            cur.execute(f"""
                 SELECT 
                     c.client_id, 
                     c.client_name, 
                     c.birth_date,
+                    TIMESTAMPDIFF(YEAR, c.birth_date, CURDATE()) AS age,
                     c.disease_name,
                     c.living_environment,
                     c.writer_name,
-                    (SELECT MAX(v.visit_datetime) FROM visit_record v WHERE v.client_id = c.client_id) as last_visit_date
+                    c.last_visit_date
                 FROM client c
+                {where}
                 ORDER BY c.client_id DESC
-            """)
+                LIMIT %s
+            """, (*params, limit + 1))
             clients = cur.fetchall()
-            
-            # Calculate age from birth_date
-            from datetime import date
-            for client in clients:
-                if client.get('birth_date'):
-                    try:
-                        birth = client['birth_date']
-                        if isinstance(birth, str):
-                            birth = datetime.strptime(birth, '%Y-%m-%d').date()
-                        today = date.today()
-                        age = today.year - birth.year - ((today.month, today.day) < (birth.month, birth.day))
-                        client['age'] = age
-                    except:
-                        client['age'] = None
-                else:
-                    client['age'] = None
 
-    return jsonify({"status": "ok", "clients": clients})
+    next_after_id = None
+    if len(clients) > limit:
+        clients = clients[:limit]
+        next_after_id = clients[-1]["client_id"]
+
+    return jsonify({"status": "ok", "clients": clients, "next_after_id": next_after_id})
 
 
 # ------- detail 画面用：一括取得API -------
 
+# 詳細画面の各タブに対応するテーブル（キー, テーブル名, 主キー, エイリアス）
+CLIENT_DETAIL_SECTIONS = [
+    ("client", "client", "client_id", "c"),
+    ("visit_record", "visit_record", "visit_record_id", "v"),
+    ("physical_status", "physical_status", "physical_status_id", "p"),
+    ("dasc21", "dasc21", "dasc_id", "d"),
+    ("dbd13", "dbd13", "dbd_id", "b"),
+]
+
+
+def build_client_bundle_query(sections):
+    """利用者の各テーブルの最新1件を1回の問い合わせで取得するSQLを組み立てる
+
+    各テーブルの列の前に `#キー` という目印の列を置き、結果をテーブルごとに分割できるようにする。
+    """
+    select_parts = []
+    join_parts = []
+    for key, table, pk, alias in sections:
+        select_parts.append(f"NULL AS `#{key}`")
+        select_parts.append(f"{alias}.*")
+        if table != "client":
+            join_parts.append(
+                f"LEFT JOIN {table} {alias} ON {alias}.{pk} = "
+                f"(SELECT MAX({pk}) FROM {table} WHERE client_id = c.client_id)"
+            )
+    return f"""
+        SELECT {", ".join(select_parts)}
+        FROM client c
+        {" ".join(join_parts)}
+        WHERE c.client_id = %s
+    """
+
+
 @app.route("/api/get_all_data")
 def get_all_data():
+    """detail画面用：利用者情報と各記録の最新1件をまとめて取得
+
+    ?include=client,visit_record のように指定すると必要なタブ分だけ返す（省略時は全て）。
+    """
     client_id = to_int_or_none(request.args.get("client_id"))
     if client_id is None:
         return jsonify({"status": "error", "message": "client_id がありません"}), 400
 
+    include = request.args.get("include")
+    if include:
+        requested = {k.strip() for k in include.split(",") if k.strip()}
+        sections = [s for s in CLIENT_DETAIL_SECTIONS if s[0] in requested]
+        if not sections:
+            return jsonify({"status": "error", "message": "include の指定が不正です"}), 400
+    else:
+        sections = CLIENT_DETAIL_SECTIONS
+
     conn = get_connection()
     with conn:
-        with conn.cursor() as cur:
-            # client
-            cur.execute("SELECT * FROM client WHERE client_id=%s", (client_id,))
-            client = cur.fetchone()
-
-            # visit_record（最新1件）
-            cur.execute(
-                "SELECT * FROM visit_record WHERE client_id=%s ORDER BY visit_record_id DESC LIMIT 1",
-                (client_id,)
-            )
-            visit_record = cur.fetchone()
-
-            # physical_status（1件）
-            cur.execute(
-                "SELECT * FROM physical_status WHERE client_id=%s ORDER BY physical_status_id DESC LIMIT 1",
-                (client_id,)
-            )
-            physical_status = cur.fetchone()
-
-            # dasc21（最新1件）
-            cur.execute(
-                "SELECT * FROM dasc21 WHERE client_id=%s ORDER BY dasc_id DESC LIMIT 1",
-                (client_id,)
-            )
-            dasc21_row = cur.fetchone()
-
-            # dbd13（最新1件）
-            cur.execute(
-                "SELECT * FROM dbd13 WHERE client_id=%s ORDER BY dbd_id DESC LIMIT 1",
-                (client_id,)
-            )
-            dbd13_row = cur.fetchone()
+        with conn.cursor(pymysql.cursors.Cursor) as cur:
+            cur.execute(build_client_bundle_query(sections), (client_id,))
+            row = cur.fetchone()
+            columns = [d[0] for d in cur.description]
+
+    result = {"status": "ok"}
+    for key, _, _, _ in sections:
+        result[key] = None
+
+    if row:
+        bundle = {}
+        current = None
+        for name, value in zip(columns, row):
+            if name.startswith("#"):
+                current = bundle.setdefault(name[1:], {})
+            else:
+                current[name] = value
+        for key, _, pk, _ in sections:
+            # LEFT JOIN で該当なしの場合は主キーが NULL になる
+            if bundle[key].get(pk) is not None:
+                result[key] = bundle[key]
 
-    return jsonify({
-        "status": "ok",
-        "client": client,
-        "visit_record": visit_record,
-        "physical_status": physical_status,
-        "dasc21": dasc21_row,
-        "dbd13": dbd13_row
-    })
+    return jsonify(result)
 
 # ================================
 #  4. 共有フォルダ（ファイル管理）
@@ -2207,5 +5168,8 @@ def export_dbd13():
 # ================================
 #  Flask 実行
 # ================================
+if SEARCH_PRELOAD:
+    start_warmup()
+
 if __name__ == "__main__":
     app.run(debug=True)
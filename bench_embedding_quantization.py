@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+埋め込み量子化のベンチマーク
+
+合成データの埋め込み（embeddings.npy）に対して、float32 の全件内積（正確な結果）と
+float16 / int8 で走査して上位候補を float32 で再計算する方式を比較し、
+メモリ量・検索時間・recall@10 を表示する。
+
+使い方:
+    python bench_embedding_quantization.py
+    python bench_embedding_quantization.py --queries 200 --scale 20 --candidates 100
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+
+import app
+
+
+def make_queries(embeddings, num_queries, rng):
+    """クエリの埋め込みを作る（モデルがあれば事例本文を query: でエンコード、なければ埋め込みに雑音を加える）"""
+    rows = rng.choice(len(embeddings), size=min(num_queries, len(embeddings)), replace=False)
+    model = app.get_embedding_model()
+    records = app.get_pdf_case_studies()
+    if model is not None and len(records) == len(embeddings):
+        texts = [f"query: {app.normalize_text(records[i]['text'][:200])}" for i in rows]
+        return app.l2_normalize(model.encode(texts, batch_size=32, convert_to_numpy=True))
+    noise = rng.normal(scale=0.05, size=(len(rows), embeddings.shape[1])).astype(np.float32)
+    return app.l2_normalize(np.asarray(embeddings[rows], dtype=np.float32) + noise)
+
+
+def scale_corpus(embeddings, scale, rng):
+    """件数を scale 倍に増やした埋め込み（雑音を加えて複製）"""
+    if scale <= 1:
+        return np.asarray(embeddings, dtype=np.float32)
+    blocks = [np.asarray(embeddings, dtype=np.float32)]
+    for _ in range(scale - 1):
+        noise = rng.normal(scale=0.05, size=embeddings.shape).astype(np.float32)
+        blocks.append(app.l2_normalize(blocks[0] + noise))
+    return np.vstack(blocks)
+
+
+def top_k(sims, rows, k=10):
+    order = np.argpartition(-sims, k - 1)[:k]
+    return set(rows[order].tolist())
+
+
+def run(embeddings, queries, candidates, k=10):
+    results = []
+
+    # 正確な結果（float32 の全件内積）
+    exact_tops = []
+    started = time.perf_counter()
+    for q in queries:
+        exact_tops.append(top_k(embeddings @ q, np.arange(len(embeddings)), k))
+    elapsed = time.perf_counter() - started
+    results.append({
+        "mode": "float32",
+        "memory_mb": embeddings.nbytes / 1e6,
+        "ms_per_query": elapsed / len(queries) * 1000,
+        "recall_at_10": 1.0
+    })
+
+    for mode in ("float16", "int8"):
+        codes, scales = app.quantize_embeddings(embeddings, mode)
+        memory = codes.nbytes + (scales.nbytes if scales is not None else 0)
+        hits = 0
+        started = time.perf_counter()
+        for q, exact in zip(queries, exact_tops):
+            rows, sims = app.search_quantized_embeddings(q, embeddings, codes, scales, candidates)
+            hits += len(top_k(sims, rows, k) & exact)
+        elapsed = time.perf_counter() - started
+        results.append({
+            "mode": f"{mode}+rerank",
+            "memory_mb": memory / 1e6,
+            "ms_per_query": elapsed / len(queries) * 1000,
+            "recall_at_10": hits / (k * len(queries))
+        })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="埋め込み量子化のベンチマーク")
+    parser.add_argument("--queries", type=int, default=100, help="クエリ数")
+    parser.add_argument("--scale", type=int, default=1, help="事例数を何倍に増やすか")
+    parser.add_argument("--candidates", type=int, default=app.QUANTIZED_RERANK_CANDIDATES, help="再計算する候補数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="結果をJSONで出力")
+    args = parser.parse_args()
+
+    embeddings, _ = app.load_synthetic_embeddings()
+    if embeddings is None:
+        raise SystemExit("embeddings.npy がありません。先に埋め込みを計算してください。")
+
+    rng = np.random.default_rng(args.seed)
+    queries = make_queries(embeddings, args.queries, rng)
+    corpus = scale_corpus(embeddings, args.scale, rng)
+    results = run(corpus, queries, args.candidates)
+
+    if args.json:
+        print(json.dumps({"num_embeddings": len(corpus), "candidates": args.candidates, "results": results}, indent=2))
+        return
+    print(f"\n事例数: {len(corpus)}  クエリ数: {len(queries)}  再計算候補数: {args.candidates}")
+    print(f"{'方式':<16}{'メモリ(MB)':>12}{'ms/クエリ':>12}{'recall@10':>12}")
+    for r in results:
+        print(f"{r['mode']:<16}{r['memory_mb']:>12.1f}{r['ms_per_query']:>12.2f}{r['recall_at_10']:>12.3f}")
+
+
+if __name__ == "__main__":
+    main()
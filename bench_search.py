@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+"""
+類似事例検索の品質・速度ベンチマーク
+
+generate_synthetic_cases.generate_all_cases で件数ごとのコーパスを作り、
+コーパスに含めない事例（ホールドアウト）の訪問記録項目（vr_*）をクエリとして各検索方式で検索する。
+正解はクエリの事例とコーパスの事例の困難キーワードの重なり（Jaccard 係数）とし、
+レイテンシ（p50/p95/p99）・スループット・ピークRSS・recall@10・nDCG@10 をJSONファイルに書き出す。
+
+検索方式:
+    tfidf       search_similar_tfidf（全件）
+    tfidf+bm25  search_similar_tfidf（BM25 の上位候補に絞ってから TF-IDF）
+    bm25        search_similar_bm25
+    hybrid      search_similar_embeddings（セマンティック + TF-IDF + キーワード）
+    embedding   search_similar_embeddings（セマンティックのみ）
+埋め込みモデルが使えない場合、hybrid / embedding は skipped として記録する。
+TFIDF_FEATURE_EXTRACTOR・EMBEDDING_QUANTIZATION などの環境変数はアプリと同じく反映され、結果の config に残す。
+
+使い方:
+    python bench_search.py
+    python bench_search.py --sizes 1000,10000,100000 --queries 200 --output bench_search_results.json
+    python bench_search.py --sizes 10000 --engines tfidf,bm25
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+
+import app
+import generate_synthetic_cases
+
+ENGINES = ["tfidf", "tfidf+bm25", "bm25", "hybrid", "embedding"]
+EMBEDDING_ENGINES = {"hybrid", "embedding"}
+# クエリにする訪問記録の項目（訪問記録表の並び）
+QUERY_FIELDS = [
+    "vr_reaction", "vr_cognition", "vr_behavior", "vr_physical", "vr_living", "vr_person_intent", "vr_family_intent"
+]
+RELEVANCE_THRESHOLD = 0.5  # recall@10 で正解とみなす困難キーワードの Jaccard 係数
+TOP_K = 10
+
+
+def peak_rss_mb():
+    """プロセスのピークRSS（MB、プロセス開始からの最大値なので単調増加）"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux は KB、macOS はバイト単位
+    return peak / 1e6 if sys.platform == "darwin" else peak / 1e3
+
+
+def generate_corpus(num_cases, num_queries, seed):
+    """コーパスの検索用レコードと、ホールドアウトしたクエリ用の事例を作る"""
+    random.seed(seed)
+    # 生成中の進捗表示は標準エラーに出す
+    with contextlib.redirect_stdout(sys.stderr):
+        cases = generate_synthetic_cases.generate_all_cases(num_cases + num_queries)["cases"]
+    records = [
+        {
+            "id": case["id"],
+            "text": case.get("visit_like_text", case["text"]),
+            "policy": case["policy"],
+            "source": case["source"],
+            "difficulty_keywords": case["difficulty_keywords"],
+            "support_keywords": case["support_keywords"],
+            "metadata": case["metadata"],
+            "client_id": None,
+            # 検索結果の text に事例IDが入るようにして、結果を行に対応付ける
+            "display_text": case["id"]
+        }
+        for case in cases[:num_cases]
+    ]
+    return records, cases[num_cases:]
+
+
+def keyword_matrix(keyword_lists):
+    """困難キーワードの出現行列（事例数×キーワード数）"""
+    position = {kw: i for i, kw in enumerate(generate_synthetic_cases.DIFFICULTY_KEYWORDS)}
+    matrix = np.zeros((len(keyword_lists), len(position)), dtype=np.float32)
+    for row, keywords in enumerate(keyword_lists):
+        matrix[row, [position[kw] for kw in keywords if kw in position]] = 1.0
+    return matrix
+
+
+def relevance_gains(corpus_keywords, query_keywords):
+    """クエリごとの全事例の関連度（困難キーワードの Jaccard 係数、クエリ数×事例数）"""
+    intersection = query_keywords @ corpus_keywords.T
+    union = query_keywords.sum(axis=1)[:, None] + corpus_keywords.sum(axis=1)[None, :] - intersection
+    return intersection / np.maximum(union, 1.0)
+
+
+def quality_metrics(retrieved_rows, gains):
+    """1クエリの recall@10 と nDCG@10（正解がなければ recall は None）"""
+    retrieved_rows = retrieved_rows[:TOP_K]
+    discounts = 1.0 / np.log2(np.arange(2, TOP_K + 2))
+    dcg = float((gains[retrieved_rows] * discounts[:len(retrieved_rows)]).sum())
+    ideal = np.sort(gains)[::-1][:TOP_K]
+    idcg = float((ideal * discounts[:len(ideal)]).sum())
+    ndcg = dcg / idcg if idcg > 0 else 0.0
+
+    relevant = np.flatnonzero(gains >= RELEVANCE_THRESHOLD)
+    if relevant.size == 0:
+        return None, ndcg
+    hits = np.isin(retrieved_rows, relevant).sum()
+    return hits / min(TOP_K, relevant.size), ndcg
+
+
+def install_corpus_embeddings(records, ann_dir):
+    """コーパスの埋め込みを計算して、アプリの合成データ埋め込みとして差し替える
+
+    ANNインデックスは本番のファイルを上書きしないよう一時ディレクトリに作る。
+    """
+    texts = [f"passage: {app.normalize_text(r['text'])}" for r in records]
+    app._synthetic_embeddings = app.l2_normalize(app.encode_texts(texts))
+    app._synthetic_ids = [r["id"] for r in records]
+    app._ann_index = (None, None, None)
+    app._quantized_embeddings = (None, None, None)
+    app.ANN_INDEX_FILE = os.path.join(ann_dir, "embeddings_hnsw.bin")
+    if os.path.exists(app.ANN_INDEX_FILE):
+        os.remove(app.ANN_INDEX_FILE)
+    app.get_ann_index(app._synthetic_embeddings, build=True)
+
+
+def make_searcher(engine, index):
+    records = index.records
+    if engine == "tfidf":
+        return lambda q, kw: app.search_similar_tfidf(q, records, kw, index=index, first_stage="none")
+    if engine == "tfidf+bm25":
+        return lambda q, kw: app.search_similar_tfidf(q, records, kw, index=index, first_stage="bm25")
+    if engine == "bm25":
+        return lambda q, kw: app.search_similar_bm25(q, records, kw, index=index)
+    weights = app.SEARCH_MODE_WEIGHTS[engine]
+    return lambda q, kw: app.search_similar_embeddings(
+        q, records, kw, index=index, first_stage="none", weights=weights
+    )
+
+
+def run_engine(engine, index, queries, gains, row_of_id):
+    """1つの検索方式でクエリを順に検索し、レイテンシと検索品質を集計する"""
+    search = make_searcher(engine, index)
+    # クエリ埋め込みのキャッシュは方式ごとに空にして、毎回エンコードする条件で測る
+    app._query_embedding_cache = app.QueryEmbeddingCache(app.QUERY_EMBEDDING_CACHE_SIZE)
+    search(queries[0], app.extract_keywords(queries[0], top_n=8))  # 初回のみの初期化を除く
+
+    latencies = []
+    recalls = []
+    ndcgs = []
+    started = time.perf_counter()
+    for q, query_gains in zip(queries, gains):
+        query_started = time.perf_counter()
+        results = search(q, app.extract_keywords(q, top_n=8))
+        latencies.append((time.perf_counter() - query_started) * 1000)
+        rows = np.array([row_of_id[r["text"]] for r in results], dtype=np.int64)
+        recall, ndcg = quality_metrics(rows, query_gains)
+        if recall is not None:
+            recalls.append(recall)
+        ndcgs.append(ndcg)
+    elapsed = time.perf_counter() - started
+
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {
+        "latency_ms": {
+            "p50": round(float(p50), 3),
+            "p95": round(float(p95), 3),
+            "p99": round(float(p99), 3),
+            "mean": round(float(np.mean(latencies)), 3)
+        },
+        "throughput_qps": round(len(queries) / elapsed, 2),
+        "recall_at_10": round(float(np.mean(recalls)), 4) if recalls else None,
+        "ndcg_at_10": round(float(np.mean(ndcgs)), 4),
+        "queries_with_relevant": len(recalls),
+        "peak_rss_mb": round(peak_rss_mb(), 1)
+    }
+
+
+def run_size(num_cases, args, engines, ann_dir):
+    started = time.perf_counter()
+    records, held_out = generate_corpus(num_cases, args.queries, args.seed)
+    generate_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    index = app.TfidfSearchIndex(records)
+    build_seconds = time.perf_counter() - started
+
+    queries = [app.normalize_text(" ".join(case[field] for field in QUERY_FIELDS)) for case in held_out]
+    gains = relevance_gains(
+        keyword_matrix([r["difficulty_keywords"] for r in records]),
+        keyword_matrix([case["difficulty_keywords"] for case in held_out])
+    )
+    row_of_id = {r["id"]: i for i, r in enumerate(records)}
+
+    result = {
+        "num_cases": num_cases,
+        "num_queries": len(queries),
+        "generate_seconds": round(generate_seconds, 2),
+        "index_build_seconds": round(build_seconds, 2),
+        "index_peak_rss_mb": round(peak_rss_mb(), 1),
+        "engines": {}
+    }
+
+    if EMBEDDING_ENGINES & set(engines):
+        if app.get_embedding_model() is None:
+            for engine in EMBEDDING_ENGINES & set(engines):
+                result["engines"][engine] = {"skipped": "埋め込みモデルが使えません"}
+            engines = [e for e in engines if e not in EMBEDDING_ENGINES]
+        else:
+            started = time.perf_counter()
+            install_corpus_embeddings(records, ann_dir)
+            result["embedding_build_seconds"] = round(time.perf_counter() - started, 2)
+
+    for engine in engines:
+        print(f"  {num_cases}件 / {engine} ...", file=sys.stderr)
+        result["engines"][engine] = run_engine(engine, index, queries, gains, row_of_id)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="類似事例検索の品質・速度ベンチマーク")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="コーパスの件数（カンマ区切り）")
+    parser.add_argument("--queries", type=int, default=200, help="ホールドアウトするクエリ数")
+    parser.add_argument("--engines", default=",".join(ENGINES), help="検索方式（カンマ区切り）")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="bench_search_results.json", help="結果のJSONファイル")
+    args = parser.parse_args()
+
+    engines = app.parse_list_param(args.engines)
+    unknown = [e for e in engines if e not in ENGINES]
+    if unknown:
+        parser.error(f"未対応の検索方式です: {', '.join(unknown)}")
+
+    report = {
+        "generated_at": datetime.now().isoformat(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "config": {
+            "queries": args.queries,
+            "seed": args.seed,
+            "relevance": f"困難キーワードの Jaccard 係数（recall@10 は {RELEVANCE_THRESHOLD} 以上を正解とする）",
+            "embedding_model": app.EMBEDDING_MODEL_NAME,
+            "embedding_backend": app.EMBEDDING_BACKEND,
+            "embedding_quantization": app.EMBEDDING_QUANTIZATION,
+            "tfidf_feature_extractor": app.TFIDF_FEATURE_EXTRACTOR,
+            "tfidf_scoring_shards": app.TFIDF_SCORING_SHARDS,
+            "bm25_candidates": app.BM25_CANDIDATES
+        },
+        "results": []
+    }
+    with tempfile.TemporaryDirectory() as ann_dir:
+        for num_cases in sorted(int(s) for s in args.sizes.split(",")):
+            report["results"].append(run_size(num_cases, args, engines, ann_dir))
+            # 途中で止めても計測済みの分は残す
+            with open(args.output, "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+
+    print(f"\n{'件数':>8}  {'方式':<12}{'p50(ms)':>10}{'p95(ms)':>10}{'p99(ms)':>10}{'QPS':>9}"
+          f"{'recall@10':>11}{'nDCG@10':>9}{'RSS(MB)':>9}")
+    for result in report["results"]:
+        for engine, r in result["engines"].items():
+            if "skipped" in r:
+                print(f"{result['num_cases']:>8}  {engine:<12}skipped: {r['skipped']}")
+                continue
+            recall = f"{r['recall_at_10']:.3f}" if r["recall_at_10"] is not None else "-"
+            print(f"{result['num_cases']:>8}  {engine:<12}{r['latency_ms']['p50']:>10.2f}{r['latency_ms']['p95']:>10.2f}"
+                  f"{r['latency_ms']['p99']:>10.2f}{r['throughput_qps']:>9.1f}{recall:>11}{r['ndcg_at_10']:>9.3f}"
+                  f"{r['peak_rss_mb']:>9.0f}")
+    print(f"\n結果を {args.output} に書き出しました")
+
+
+if __name__ == "__main__":
+    main()
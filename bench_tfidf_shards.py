@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+TF-IDF 分割スコアリングのベンチマーク
+
+事例集で学習した文書行列を --scale 倍に複製した大規模コーパスを作り、
+分割数（スレッド数）ごとに1クエリあたりの検索時間（類似度計算 + 上位候補の選択）を計測する。
+
+使い方:
+    python bench_tfidf_shards.py
+    python bench_tfidf_shards.py --scale 100 --shards 1,2,4,8,16,32
+"""
+
+import argparse
+import json
+import os
+import random
+import time
+
+import scipy.sparse as sp
+
+import app
+
+
+def build_scaled_index(scale):
+    records = app.get_pdf_case_studies()
+    base = app.TfidfSearchIndex(records)
+    scaled_records = records * scale
+    doc_matrix = sp.vstack([base.doc_matrix] * scale).tocsr()
+    return app.TfidfSearchIndex(scaled_records, vectorizer=base.vectorizer, doc_matrix=doc_matrix), records
+
+
+def main():
+    cpu_count = os.cpu_count() or 1
+    default_shards = sorted({1, 2, 4, 8, 16, 32, cpu_count})
+    parser = argparse.ArgumentParser(description="TF-IDF 分割スコアリングのベンチマーク")
+    parser.add_argument("--scale", type=int, default=40, help="事例数を何倍に増やすか")
+    parser.add_argument("--shards", default=",".join(map(str, default_shards)), help="試す分割数（カンマ区切り）")
+    parser.add_argument("--queries", type=int, default=20, help="クエリ数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="結果をJSONで出力")
+    args = parser.parse_args()
+
+    index, records = build_scaled_index(args.scale)
+    random.seed(args.seed)
+    queries = [
+        app.normalize_text(app.get_display_text(r)[:200])
+        for r in random.sample(records, min(args.queries, len(records)))
+    ]
+
+    # 分割の下限を外して、指定した分割数をそのまま使う
+    app.TFIDF_SHARD_MIN_ROWS = 1
+    results = []
+    baseline = None
+    for shards in [int(s) for s in args.shards.split(",")]:
+        index.set_shards(shards)
+        app.search_similar_tfidf(queries[0], None, [], index=index)  # スレッドプールの起動分を除く
+        started = time.perf_counter()
+        for q in queries:
+            app.search_similar_tfidf(q, None, [], index=index)
+        ms = (time.perf_counter() - started) / len(queries) * 1000
+        baseline = baseline or ms
+        results.append({"shards": index.shards, "ms_per_query": ms, "speedup": baseline / ms})
+
+    if args.json:
+        print(json.dumps({"num_documents": len(index.records), "cpu_count": cpu_count, "results": results}, indent=2))
+        return
+    print(f"\n文書数: {len(index.records)}  CPUコア数: {cpu_count}  クエリ数: {len(queries)}")
+    print(f"{'分割数':>6}{'ms/クエリ':>12}{'速度比':>10}")
+    for r in results:
+        print(f"{r['shards']:>6}{r['ms_per_query']:>12.1f}{r['speedup']:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+"""
+検索アーティファクトの事前構築スクリプト
+
+cases.json と visit_record テーブルから、類似事例検索に必要なデータ
+（TF-IDFの語彙・IDF、文書行列、埋め込み、キーワード出現行列、IDの対応）を構築し、
+版ごとのディレクトリに書き出す。アプリは起動時に最新の版を読み取り専用でロードする。
+埋め込みの件数が ANN_INDEX_MIN_SIZE 以上なら、書き出した埋め込みの HNSW インデックスもここで作る。
+
+使い方:
+    python build_search_index.py
+    python build_search_index.py --output /srv/care/search_index --no-embeddings
+"""
+
+import argparse
+import json
+import os
+
+import app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="検索アーティファクトの事前構築")
+    parser.add_argument("--output", default=app.SEARCH_ARTIFACTS_DIR, help="出力先ディレクトリ")
+    parser.add_argument("--no-embeddings", action="store_true", help="埋め込みを含めない")
+    args = parser.parse_args()
+
+    version = app.write_search_artifacts(args.output, with_embeddings=not args.no_embeddings)
+
+    with open(os.path.join(args.output, version, "manifest.json"), "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    print(f"\n完了: {os.path.join(args.output, version)}")
+    print(f"  レコード数: {manifest['num_records']}")
+    for name, digest in manifest["files"].items():
+        print(f"  {name}: {digest[:12]}")
+
+    # 検索リクエストの中で HNSW インデックスを作らずに済むよう、アプリがロードする埋め込みに対して作っておく
+    if "embeddings" in manifest["files"] and app.load_search_artifacts(args.output) is not None:
+        embeddings, _ = app.load_synthetic_embeddings()
+        if app.get_ann_index(embeddings, build=True) is not None:
+            print(f"  HNSWインデックス: {app.ANN_INDEX_FILE}")
+
+
+if __name__ == "__main__":
+    main()
@@ -82,7 +82,8 @@ CREATE TABLE `client` (
   `medical_history` text DEFAULT NULL,
   `current_condition` text DEFAULT NULL,
   `public_services` text DEFAULT NULL,
-  `private_services` text DEFAULT NULL
+  `private_services` text DEFAULT NULL,
+  `last_visit_date` datetime DEFAULT NULL COMMENT '最終訪問日（visit_record 保存時に更新）'
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
 
 --
@@ -238,7 +239,8 @@ CREATE TABLE `visit_record` (
   `vr_jzbi` int(11) DEFAULT NULL COMMENT 'J-ZBI8 点数',
   `vr_person_intent` text DEFAULT NULL COMMENT '本人の意向・希望',
   `vr_family_intent` text DEFAULT NULL COMMENT '介護者の意向・希望',
-  `vr_other` text DEFAULT NULL COMMENT 'その他'
+  `vr_other` text DEFAULT NULL COMMENT 'その他',
+  `updated_at` datetime(6) NOT NULL DEFAULT current_timestamp(6) ON UPDATE current_timestamp(6) COMMENT '最終更新日時（類似検索インデックスの変更検知用）'
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
 
 --
@@ -267,6 +269,13 @@ INSERT INTO `visit_record` (`visit_record_id`, `client_id`, `physical_status_id`
 (20, 22, NULL, '2025-12-13 00:39:53', '包括支援センター 佐藤', '妻からの相談対応', '', 'アルコール問題への対応と妻の安全確保が必要。', '1.アルコール専門医療機関への相談 2.妻への支援（DV相談窓口の紹介） 3.断酒会などの自助グループの紹介 4.妻の避難先の確保', '酒臭あり。ろれつが回らない状態。「何の用だ」と不機嫌。', 'アルコール性認知症の疑い。認知機能の評価が困難（飲酒の影響）。', '評価困難', '飲酒時に暴言あり。妻に対して怒鳴ることがある。物を投げることも。', 'アルコール性肝障害あり。栄養状態不良。歩行時のふらつきあり。', 'J2', '妻と二人暮らし。朝から飲酒。妻は精神的に疲弊している。', NULL, NULL, NULL, '酒は百薬の長。やめる必要はない。', '夫の飲酒をやめさせたい。暴言が怖い。離婚も考えている。', 'アルコール依存と認知症の合併。DV（精神的虐待）の疑いもあり。'),
 (21, 23, NULL, '2025-12-13 00:43:06', '包括支援センター 田中', '民生委員・社協からの相談対応', '', '多機関連携による包括的支援が必要。緊急性の高いケース。', '1.生活保護の申請支援 2.長男の精神科受診支援 3.社会福祉協議会と連携し、緊急小口資金の利用 4.ライフライン停止防止のための調整 5.本人の医療機関受診', '疲れた様子。「どうしていいかわからない」と涙ぐむ。', '軽度～中等度の認知機能低下の疑い。ストレスで認知機能が低下している可能性も。', '評価困難', '特に問題行動なし。むしろ、長男の世話で疲弊している。', '健康状態不明。医療機関未受診。栄養状態不良の疑い。', 'J2', '独居だが、精神疾患のある長男が頻繁に来て金銭を要求。電気代が払えず、停止の危機。', NULL, NULL, NULL, '息子を見捨てられない。でも、もう限界。', '長男は精神疾患あり。母親に依存。金銭管理ができない。', '多問題世帯。経済的困窮、長男の精神疾患、本人の認知症疑い。複合的な支援が必要。');
 
+--
+-- 最終訪問日の初期値 `client`.`last_visit_date`
+--
+
+UPDATE `client` c
+   SET c.`last_visit_date` = (SELECT MAX(v.`visit_datetime`) FROM `visit_record` v WHERE v.`client_id` = c.`client_id`);
+
 --
 -- ダンプしたテーブルのインデックス
 --
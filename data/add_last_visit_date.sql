@@ -0,0 +1,10 @@
+-- =====================================================
+-- 既存DB向け：client.last_visit_date 列の追加
+-- （対象者一覧で最終訪問日を毎回集計しないよう、訪問記録の保存時に更新する）
+-- =====================================================
+
+ALTER TABLE client
+  ADD COLUMN last_visit_date datetime DEFAULT NULL COMMENT '最終訪問日（visit_record 保存時に更新）';
+
+UPDATE client c
+   SET c.last_visit_date = (SELECT MAX(v.visit_datetime) FROM visit_record v WHERE v.client_id = c.client_id);
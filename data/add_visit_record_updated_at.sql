@@ -0,0 +1,8 @@
+-- =====================================================
+-- 既存DB向け：visit_record.updated_at 列の追加
+-- （訪問記録の上書き保存を類似検索インデックスの変更検知で捉えるため）
+-- =====================================================
+
+ALTER TABLE visit_record
+  ADD COLUMN updated_at datetime(6) NOT NULL DEFAULT current_timestamp(6) ON UPDATE current_timestamp(6)
+  COMMENT '最終更新日時（類似検索インデックスの変更検知用）';
@@ -341,3 +341,7 @@ VALUES (120, '2025-02-03 10:00:00', '包括支援センター 田中', '民生
 '多問題世帯。経済的困窮、長男の精神疾患、本人の認知症疑い。複合的な支援が必要。',
 '多機関連携による包括的支援が必要。緊急性の高いケース。',
 '1.生活保護の申請支援 2.長男の精神科受診支援 3.社会福祉協議会と連携し、緊急小口資金の利用 4.ライフライン停止防止のための調整 5.本人の医療機関受診');
+
+-- 最終訪問日（client.last_visit_date）を訪問記録から再計算
+UPDATE client c
+   SET c.last_visit_date = (SELECT MAX(v.visit_datetime) FROM visit_record v WHERE v.client_id = c.client_id);
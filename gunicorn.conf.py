@@ -0,0 +1,18 @@
+"""
+gunicorn 設定
+
+    SEARCH_PRELOAD=1 gunicorn app:app
+
+各ワーカーの起動直後（post_fork）に検索のウォームアップを開始する。
+ロードバランサーは /readyz が 200 を返すまでワーカーに振り分けないこと。
+"""
+
+bind = "0.0.0.0:8000"
+workers = 2
+timeout = 120
+
+
+def post_fork(server, worker):
+    import app
+    if app.SEARCH_PRELOAD:
+        app.start_warmup()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+類似事例のバッチ検索スクリプト
+
+月次の事例検討などで、複数の利用者・入力をまとめて類似事例検索する。
+結果は1件ごとに1行のJSON（NDJSON）で出力する。
+
+使い方:
+    python search_batch.py --all-clients > results.ndjson
+    python search_batch.py --client-ids 1,2,3 --method hybrid
+    python search_batch.py --input queries.jsonl --output results.ndjson
+"""
+
+import argparse
+import json
+import sys
+
+import app
+
+
+def read_queries(path):
+    """1行1クエリのファイルを読み込む（JSON または プレーンテキスト）"""
+    queries = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                queries.append(json.loads(line))
+            except json.JSONDecodeError:
+                queries.append(line)
+    return queries
+
+
+def main():
+    parser = argparse.ArgumentParser(description="類似事例のバッチ検索（NDJSON出力）")
+    parser.add_argument("--input", help="1行1クエリのファイル（JSON または テキスト）")
+    parser.add_argument("--client-ids", help="カンマ区切りの利用者ID")
+    parser.add_argument("--all-clients", action="store_true", help="訪問記録のある全利用者で検索する")
+    parser.add_argument("--method", choices=["tfidf", "hybrid"], default="tfidf")
+    parser.add_argument("--filters", help="メタデータの絞り込み条件（JSON）")
+    parser.add_argument("--required-keywords", help="必須キーワード（カンマ区切り）")
+    parser.add_argument("--output", help="出力先（省略時は標準出力）")
+    args = parser.parse_args()
+
+    index = app.get_tfidf_index()
+
+    data = {"queries": [], "client_ids": []}
+    if args.input:
+        data["queries"] = read_queries(args.input)
+    if args.client_ids:
+        data["client_ids"] = [int(cid) for cid in app.parse_list_param(args.client_ids)]
+    if args.all_clients:
+        data["client_ids"] = index.client_ids()
+
+    queries = app.resolve_batch_queries(index, data)
+    if not queries:
+        parser.error("--input / --client-ids / --all-clients のいずれかを指定してください")
+
+    filters = json.loads(args.filters) if args.filters else None
+    required_keywords = app.parse_list_param(args.required_keywords)
+
+    out = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    try:
+        for item in app.iter_batch_search(index, queries, args.method, required_keywords, filters):
+            out.write(json.dumps(item, ensure_ascii=False) + "\n")
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    print(f"{len(queries)}件の検索が完了しました", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()